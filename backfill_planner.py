@@ -0,0 +1,171 @@
+"""plan of a backfill of a range of analysis hours and a set of forecast hours.
+the plan builds the graph of the grib2 files every output needs, i.e., the _b file of f00 and the
+previous forecast hour of the accumulated columns, with all idx fetched concurrently by make_grib2data.
+outputs complete in the manifest are skipped, and outputs whose inputs are missing are reported up front.
+the outputs of an analysis hour are processed as one grib2run, which hands the accumulated values of
+forecast hour N-1 to N, and the runs are chained so that f00 takes the values of f01 of the previous
+analysis hour, it waits for them. so a message needed by several outputs is downloaded once, by its own
+file if it is in the plan and by the output that needs it otherwise, and it is counted once in the plan.
+a run of one forecast hour which is not chained hands nothing to another run, e.g., with hours_forecast [0],
+the files of these runs are processed by the pipeline of process_grib2_az instead, see run.
+the number of requests and bytes of the plan are estimated from the idx with the same merging of byte
+ranges as the downloads. the plan keeps the urls and the byte ranges of the messages it needs, not the
+grib2data objects nor the whole idx"""
+from grib2data import make_grib2data, plan_byte_ranges, timestamp_to_url, get_grid_key
+from grib2run import grib2run
+from utils import range_gap_max, backfill_n_runs
+from numpy import asarray, intp
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+import asyncio
+import json
+
+url_root_NOAAHRRR = "https://noaahrrr.blob.core.windows.net/hrrr"
+
+
+def get_lst_url_grib2(dttm_start, dttm_end, hours_forecast, url_root=url_root_NOAAHRRR):
+    """grib2 urls of the analysis hours in [dttm_start, dttm_end) and hours_forecast, in execution order"""
+    lst_url_grib2 = []
+    analysis_dttm = dttm_start
+    while analysis_dttm < dttm_end:
+        for hour_forecast in sorted(hours_forecast):
+            lst_url_grib2.append(timestamp_to_url(analysis_dttm, f"{hour_forecast:02}", url_root))
+        analysis_dttm += timedelta(hours=1)
+
+    return lst_url_grib2
+
+
+def get_size_mean(dict_var_br):
+    """mean size of the messages of a grib2 file from its idx, the last message has no size"""
+    lst_size = [int(br.split('-')[1]) - int(br.split('-')[0]) + 1 for (br, _) in dict_var_br.values() if not br.endswith('-')]
+
+    return sum(lst_size)//max(1, len(lst_size))
+
+
+def estimate_messages(dict_msg, gap_max=range_gap_max):
+    """number of requests and bytes to download the messages
+    input: dict_msg / url_grib2 -> (dict_var_br of the messages, set of var_num, mean message size of the file)
+    output: n_requests, n_bytes, a range to the end of a file is counted as the mean message size"""
+    n_requests, n_bytes = 0, 0
+    for (dict_var_br, set_var_num, size_mean) in dict_msg.values():
+        for (range_start, range_end, _) in plan_byte_ranges(list(set_var_num), dict_var_br, gap_max):
+            n_requests += 1
+            n_bytes += (range_end - range_start + 1) if range_end is not None else size_mean
+
+    return n_requests, n_bytes
+
+
+def is_single(run):
+    """True if grib2run has one forecast hour and is not chained to another run"""
+    return len(run.hours_forecast) == 1 and run.future_values_b is None and run.future_values_f01 is None
+
+
+class backfill_plan(object):
+    """outputs to process, from the oldest analysis hour to the latest, and their cost.
+    gap_max and kwargs are passed to grib2data, for the plan and for the runs"""
+    def __init__(self, dttm_start, dttm_end, hours_forecast, lst_unique_grid, manifest_outputs=None,
+                 url_root=url_root_NOAAHRRR, gap_max=range_gap_max, **kwargs):
+        # one intp copy of the grid points and one key shared by all grib2data of the plan and of its runs
+        self.arr_unique_grid = asarray(lst_unique_grid, dtype=intp)
+        self.grid_key = get_grid_key(self.arr_unique_grid)
+        self.kwargs = dict(kwargs, gap_max=gap_max)
+        lst_url_all = get_lst_url_grib2(dttm_start, dttm_end, hours_forecast, url_root)
+        lst_url_missing = manifest_outputs.get_missing(lst_url_all) if manifest_outputs is not None else lst_url_all
+        self.n_outputs = len(lst_url_all)
+        self.n_complete = len(lst_url_all) - len(lst_url_missing)
+
+        self.lst_url_grib2 = []
+        # forecast hours to process of every analysis hour, analysis_dttm -> (url_grib2, list of forecast hours)
+        self.dict_hours = OrderedDict()
+        # messages of the plan, the same message needed by several outputs is kept once,
+        # url_grib2 -> (dict_var_br of the messages, set of var_num, mean message size of the file)
+        self.dict_msg = OrderedDict()
+        self.n_messages_needed = 0
+
+        def add_output(grib2, fields):
+            self.lst_url_grib2.append(grib2.url_grib2)
+            self.dict_hours.setdefault(grib2.analysis_dttm, (grib2.url_grib2, []))[1].append(grib2.valid_hour)
+            for lst_msg in fields.values():
+                for (url_grib2, var_num, dict_var_br) in lst_msg:
+                    if var_num != 0:
+                        self.n_messages_needed += 1
+                        if url_grib2 not in self.dict_msg:
+                            self.dict_msg[url_grib2] = (OrderedDict(), set(), get_size_mean(dict_var_br))
+                        self.dict_msg[url_grib2][0][var_num] = dict_var_br[var_num]
+                        self.dict_msg[url_grib2][1].add(var_num)
+
+        # all idx of the outputs and of their dependencies are fetched here
+        _, self.report = make_grib2data(lst_url_missing, self.arr_unique_grid, on_ready=add_output, **self.kwargs)
+        self.n_requests, self.n_bytes = estimate_messages(self.dict_msg, gap_max)
+
+    def get_runs(self):
+        """one grib2run per analysis hour with the forecast hours to process, from the oldest to the latest,
+        the run of an analysis hour with f00 is chained to the run of the previous one if it has f01"""
+        lst_run = []
+        dict_run = {}
+        for analysis_dttm, (url_grib2, hours_forecast) in self.dict_hours.items():
+            run = grib2run(url_grib2, self.arr_unique_grid, hours_forecast, grid_key=self.grid_key, **self.kwargs)
+            run_prev = dict_run.get(analysis_dttm - timedelta(hours=1))
+            if 0 in hours_forecast and run_prev is not None and 1 in run_prev.hours_forecast:
+                run_prev.future_values_f01 = run.future_values_b = Future()
+            dict_run[analysis_dttm] = run
+            lst_run.append(run)
+
+        return lst_run
+
+    def run(self, container_client, manifest_outputs=None, n_runs=backfill_n_runs, process_async=None):
+        """process the plan with n_runs analysis hours at the same time, the runs are started from the oldest
+        analysis hour so a run never waits for one which is not started.
+        input: process_async / pipeline of many files, i.e., process_grib2_az_async, the files of the runs of one
+        forecast hour which are not chained are processed by it at the same time as the other runs
+        output: number of runs and files which failed"""
+        lst_run = self.get_runs()
+        lst_url_pipeline = []
+        if process_async is not None:
+            lst_url_pipeline = [run.get_url_grib2(run.hours_forecast[0]) for run in lst_run if is_single(run)]
+            lst_run = [run for run in lst_run if not is_single(run)]
+        n_failed = 0
+
+        def process_run(run):
+            try:
+                run.process(container_client, manifest_outputs)
+            except Exception as e:
+                print("failed", run, repr(e), flush=True)
+                return False
+            print(run, run.dict_status, flush=True)
+            return True
+
+        with ThreadPoolExecutor(n_runs) as executor:
+            # the runs are all submitted here
+            lst_processed = executor.map(process_run, lst_run)
+            if lst_url_pipeline:
+                n_failed += asyncio.run(process_async(lst_url_pipeline, self.arr_unique_grid, container_client,
+                                                      manifest_outputs, grid_key=self.grid_key, **self.kwargs))
+            for processed in lst_processed:
+                n_failed += not processed
+
+        return n_failed
+
+    def summary(self):
+        """counts of the plan and its estimated cost"""
+        return {"n_outputs": self.n_outputs,
+                "n_complete": self.n_complete,
+                "n_to_process": len(self.lst_url_grib2),
+                "n_missing_inputs": len(self.report["missing"]),
+                "n_failed_idx": len(self.report["failed"]),
+                "n_incomplete": len(self.report["incomplete"]),
+                "n_files": len(self.dict_msg),
+                "n_messages": sum(len(set_var_num) for (_, set_var_num, _) in self.dict_msg.values()),
+                "n_messages_needed": self.n_messages_needed,
+                "n_requests": self.n_requests,
+                "n_bytes": self.n_bytes}
+
+    def print_summary(self):
+        print(json.dumps(self.summary(), indent=1), flush=True)
+        for url_grib2, lst_missing in self.report["missing"].items():
+            print("missing", url_grib2, lst_missing, flush=True)
+        for url_grib2, error in self.report["failed"].items():
+            print("failed", url_grib2, error, flush=True)
+        for url_grib2, lst_column in self.report["incomplete"].items():
+            print("incomplete", url_grib2, lst_column, flush=True)
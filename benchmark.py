@@ -0,0 +1,308 @@
+"""offline benchmark of grib2data.
+synthetic HRRR grib2 files and their idx are written to a temporary directory and served by a local
+HTTP server with Range support, configurable latency and bandwidth, running in its own process so the
+peak RSS is the one of grib2data, and the outputs are uploaded to an in-memory container.
+f00, f01 and f02 files of HRRR v3 and v4 are processed end-to-end, with the time of every stage,
+the throughput and the peak RSS reported and compared to a stored baseline.
+usage: python benchmark.py [--latency 0.02] [--bandwidth 50] [--save-baseline | --compare]"""
+from utils import dict_var_index, dict_var_name
+from grib2data import grib2data
+from field_cache import cache_fields
+from idx_store import store_idx
+from metrics import recorder
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue, Value
+from pathlib import Path
+import numpy as np
+import statistics
+import argparse
+import resource
+import tempfile
+import eccodes
+import json
+import time
+import re
+
+# number of messages of a file by (version, forecast hour 00/01 or 02+), see utils.get_hrrr_ver
+dict_n_messages = {("v3", False): 148, ("v4", False): 170, ("v3", True): 151, ("v4", True): 173}
+# analysis hour whose f00, f01 and f02 are processed, the previous hour's f01 is needed by f00
+dict_analysis_dttm = {"v3": datetime(2020, 6, 1, 12), "v4": datetime(2021, 6, 1, 12)}
+
+baseline_path = Path(__file__).parent/"benchmark_baseline.json"
+
+
+def get_time_range(var, hour_forecast):
+    """a time range of var in forecast hour_forecast matching utils.dict_var_name"""
+    rs_time_range = dict_var_name[var][2]
+    if "acc" in rs_time_range:
+        return rs_time_range.format(h=hour_forecast, h_prev=hour_forecast-1)
+    if rs_time_range == ".*":
+        return f"{max(hour_forecast-1, 0)}-{hour_forecast} hour max fcst"
+
+    return "anl" if hour_forecast == 0 else f"{hour_forecast} hour fcst"
+
+
+def get_idx_names(version_hrrr, hour_forecast):
+    """(shortName, level, time range) of every message of a synthetic file,
+    the variables used by grib2data are at their positions in utils.dict_var_index"""
+    n_messages = dict_n_messages[(version_hrrr, hour_forecast >= 2)]
+    lst_name = [(f"VAR{i}", "surface", get_time_range("temperature_2m", hour_forecast)) for i in range(1, n_messages+1)]
+    for var, dict_version in dict_var_index.items():
+        if var == "CAPE255_h00_h01" and hour_forecast >= 2 or var == "CAPE255_h02plus" and hour_forecast < 2:
+            continue
+        if var == "precipitation_tot_past_h" and hour_forecast < 2:
+            continue
+        var_num = dict_version[version_hrrr]
+        if var_num != 0:
+            short_name, level, _ = dict_var_name[var]
+            lst_name[var_num-1] = (short_name, level, get_time_range(var, hour_forecast))
+
+    return lst_name
+
+
+def make_messages(nx, ny, n_distinct=4, seed=0):
+    """a few encoded grib2 messages with random values on a nx by ny grid, reused for all messages"""
+    rng = np.random.default_rng(seed)
+    lst_msg = []
+    for _ in range(n_distinct):
+        gid = eccodes.codes_grib_new_from_samples("GRIB2")
+        eccodes.codes_set(gid, "Ni", nx)
+        eccodes.codes_set(gid, "Nj", ny)
+        eccodes.codes_set(gid, "bitsPerValue", 16)
+        eccodes.codes_set_values(gid, rng.normal(280, 10, nx*ny))
+        lst_msg.append(eccodes.codes_get_message(gid))
+        eccodes.codes_release(gid)
+
+    return lst_msg
+
+
+def write_hrrr_file(root, analysis_dttm, hour_forecast, version_hrrr, lst_msg):
+    """write a synthetic grib2 file and its idx under root, with the layout of the HRRR container"""
+    path = Path(root)/f"hrrr.{analysis_dttm:%Y%m%d}/conus/hrrr.t{analysis_dttm:%H}z.wrfsfcf{hour_forecast:02}.grib2"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lst_idx = []
+    offset = 0
+    with open(path, "wb") as f:
+        for i, (short_name, level, time_range) in enumerate(get_idx_names(version_hrrr, hour_forecast)):
+            msg = lst_msg[i % len(lst_msg)]
+            lst_idx.append(f"{i+1}:{offset}:d={analysis_dttm:%Y%m%d%H}:{short_name}:{level}:{time_range}:")
+            f.write(msg)
+            offset += len(msg)
+    with open(f"{path}.idx", "w") as f:
+        f.write("\n".join(lst_idx) + "\n")
+
+    return path
+
+
+def make_handler(root, latency, bandwidth, n_requests, n_bytes):
+    """request handler serving root with single byte ranges, latency in seconds
+    before every response and bandwidth in MB/s, 0 for unlimited.
+    n_requests and n_bytes are shared counters of the requests and bytes served"""
+    class handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(root), **kwargs)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = Path(self.translate_path(self.path))
+            if not path.is_file():
+                self.send_error(404)
+                return
+            # only the requested range is read from the file
+            size = path.stat().st_size
+            matched = re.findall(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ''))
+            if matched:
+                range_start = int(matched[0][0])
+                range_end = int(matched[0][1]) if matched[0][1] else size - 1
+                range_end = min(range_end, size - 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {range_start}-{range_end}/{size}")
+            else:
+                range_start, range_end = 0, size - 1
+                self.send_response(200)
+            n_body = range_end - range_start + 1
+            self.send_header("Content-Length", str(n_body))
+            self.end_headers()
+            with n_requests.get_lock():
+                n_requests.value += 1
+            with n_bytes.get_lock():
+                n_bytes.value += n_body
+            chunk = 64*1024
+            with open(path, "rb") as f:
+                f.seek(range_start)
+                n_left = n_body
+                while n_left > 0:
+                    body = f.read(min(chunk, n_left))
+                    if not body:
+                        break
+                    self.wfile.write(body)
+                    n_left -= len(body)
+                    if bandwidth:
+                        time.sleep(len(body)/(bandwidth*1e6))
+
+    return handler
+
+
+def serve(root, latency, bandwidth, n_requests, n_bytes, queue_port):
+    """run the HTTP server on a free port, which is put in queue_port, until the process is terminated"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(root, latency, bandwidth, n_requests, n_bytes))
+    queue_port.put(server.server_address[1])
+    server.serve_forever()
+
+
+class local_blob_client(object):
+    """stand-in of azure BlobClient storing uploads in its container"""
+    def __init__(self, container, blob):
+        self.container = container
+        self.blob = blob
+
+    def upload_blob(self, data, length=None, overwrite=False, max_concurrency=1):
+        if not overwrite and self.blob in self.container.blobs:
+            raise FileExistsError(self.blob)
+        self.container.blobs[self.blob] = data.read() if hasattr(data, "read") else bytes(data)
+
+
+class local_container_client(object):
+    """stand-in of azure ContainerClient keeping the blobs in memory"""
+    def __init__(self):
+        self.blobs = {}
+
+    def get_blob_client(self, blob):
+        return local_blob_client(self, blob)
+
+    def list_blobs(self, name_starts_with=''):
+        return [{"name": name, "size": len(data)} for (name, data) in self.blobs.items()
+                if name.startswith(name_starts_with)]
+
+
+def run_case(url_grib2, lst_unique_grid, container_client):
+    """process one file, output: seconds of every stage"""
+    timings = {}
+    t = time.perf_counter()
+    grib2 = grib2data(url_grib2, lst_unique_grid)
+    grib2.entry_idx
+    timings["idx"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    grib2.fetch()
+    timings["fetch"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    grib2.get_vars()
+    timings["decode"] = time.perf_counter() - t
+
+    # the production upload, which serializes the df in its serialize span
+    t = time.perf_counter()
+    grib2.upload_blob(container_client)
+    timings["serialize"] = recorder.dict_seconds["serialize"][-1]
+    timings["upload"] = time.perf_counter() - t - timings["serialize"]
+    timings["total"] = sum(timings.values())
+
+    return timings
+
+
+def run_benchmark(nx, ny, n_points, n_repeat, latency, bandwidth):
+    """generate the files, serve them and process every case n_repeat times, the files are removed at the end
+    output: dict of case -> stage -> median seconds, and the run-level results"""
+    with tempfile.TemporaryDirectory(prefix="hrrr_bench_") as dir_root:
+        return run_benchmark_in(Path(dir_root), nx, ny, n_points, n_repeat, latency, bandwidth)
+
+
+def run_benchmark_in(root, nx, ny, n_points, n_repeat, latency, bandwidth):
+    """run_benchmark with the files under the directory root"""
+    # url_root ends with hrrrdata/GRIB2 like our own copy, see get_url_grib2_relative
+    lst_msg = make_messages(nx, ny)
+    for version_hrrr, analysis_dttm in dict_analysis_dttm.items():
+        write_hrrr_file(root/"hrrrdata"/"GRIB2", analysis_dttm - timedelta(hours=1), 1, version_hrrr, lst_msg)
+        for hour_forecast in [0, 1, 2]:
+            write_hrrr_file(root/"hrrrdata"/"GRIB2", analysis_dttm, hour_forecast, version_hrrr, lst_msg)
+
+    n_requests, n_bytes = Value("q", 0), Value("q", 0)
+    queue_port = Queue()
+    process_server = Process(target=serve, args=(root, latency, bandwidth, n_requests, n_bytes, queue_port), daemon=True)
+    process_server.start()
+    url_root = f"http://127.0.0.1:{queue_port.get()}/hrrrdata/GRIB2"
+
+    lst_unique_grid = np.sort(np.random.default_rng(1).choice(nx*ny, n_points, replace=False))
+    container_client = local_container_client()
+    results = {}
+    t_start = time.perf_counter()
+    try:
+        run_cases(url_root, lst_unique_grid, container_client, n_repeat, results)
+    finally:
+        process_server.terminate()
+        process_server.join()
+    seconds = time.perf_counter() - t_start
+
+    n_files = len(results)*n_repeat
+    summary = {"files_per_s": n_files/seconds,
+               "mb_per_s": n_bytes.value/1e6/seconds,
+               "requests_per_file": n_requests.value/n_files,
+               "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+               "spans": recorder.summary()["spans"]}
+
+    return results, summary
+
+
+def run_cases(url_root, lst_unique_grid, container_client, n_repeat, results):
+    """process every case n_repeat times, the median seconds of every stage are put in results"""
+    for version_hrrr, analysis_dttm in dict_analysis_dttm.items():
+        for hour_forecast in [0, 1, 2]:
+            url_grib2 = f"{url_root}/hrrr.{analysis_dttm:%Y%m%d}/conus/hrrr.t{analysis_dttm:%H}z.wrfsfcf{hour_forecast:02}.grib2"
+            lst_timings = []
+            for _ in range(n_repeat):
+                # every repetition starts cold
+                cache_fields.clear()
+                store_idx.clear()
+                lst_timings.append(run_case(url_grib2, lst_unique_grid, container_client))
+            results[f"{version_hrrr}_f{hour_forecast:02}"] = {
+                stage: statistics.median(timings[stage] for timings in lst_timings) for stage in lst_timings[0]}
+
+
+def compare(results, baseline, tolerance):
+    """stages slower than baseline by more than tolerance, as a list of (case, stage, seconds, baseline seconds)"""
+    lst_slower = []
+    for case, timings in results.items():
+        for stage, seconds in timings.items():
+            seconds_baseline = baseline.get("results", {}).get(case, {}).get(stage)
+            if seconds_baseline and seconds > seconds_baseline*(1 + tolerance):
+                lst_slower.append((case, stage, seconds, seconds_baseline))
+
+    return lst_slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmark of grib2data")
+    parser.add_argument("--nx", type=int, default=1799, help="grid size in x, HRRR CONUS is 1799")
+    parser.add_argument("--ny", type=int, default=1059, help="grid size in y, HRRR CONUS is 1059")
+    parser.add_argument("--points", type=int, default=100000, help="number of grid points extracted")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="MB/s per response, 0 for unlimited")
+    parser.add_argument("--baseline", type=Path, default=baseline_path)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="exit with 1 if a stage regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    results, summary = run_benchmark(args.nx, args.ny, args.points, args.repeat, args.latency, args.bandwidth)
+    stages = list(next(iter(results.values())))
+    print("case".ljust(8) + ''.join(stage.rjust(11) for stage in stages))
+    for case, timings in results.items():
+        print(case.ljust(8) + ''.join(f"{timings[stage]:11.4f}" for stage in stages))
+    print(json.dumps(summary, indent=1))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"args": vars(args) | {"baseline": str(args.baseline)}, "results": results, "summary": summary},
+                      f, indent=1)
+    elif args.compare:
+        with open(args.baseline) as f:
+            lst_slower = compare(results, json.load(f), args.tolerance)
+        for (case, stage, seconds, seconds_baseline) in lst_slower:
+            print(f"regression {case} {stage}: {seconds:.4f}s, baseline {seconds_baseline:.4f}s")
+        raise SystemExit(1 if lst_slower else 0)
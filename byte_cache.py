@@ -0,0 +1,100 @@
+"""optional on-disk cache of downloaded grib2 messages, keyed by (url_grib2, byte range).
+reprocessing files already touched reads the messages from the local disk instead
+of downloading them again. files are written atomically and the least recently used
+are evicted when the cache grows over its budget, so concurrent workers can share it"""
+from utils import cache_bytes_dir, cache_bytes_max_bytes
+from threading import Lock
+from pathlib import Path
+import tempfile
+import hashlib
+import os
+
+
+class byte_cache(object):
+    """messages stored as cache_dir/<first 2 hex of the key>/<key>, the mtime of a file is its last use"""
+    def __init__(self, cache_dir, max_bytes=cache_bytes_max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = Lock()
+        # approximate, other workers write to the same directory
+        self.n_bytes = sum(p.stat().st_size for p in self._files())
+
+    def _files(self):
+        return [p for p in self.cache_dir.glob("*/*") if not p.name.startswith(".")]
+
+    def _path(self, url_grib2, br):
+        key = hashlib.sha256(f"{url_grib2}:{br}".encode()).hexdigest()
+
+        return self.cache_dir/key[:2]/key
+
+    def get(self, url_grib2, br):
+        """the cached message of url_grib2 at byte range br, None if it is not cached"""
+        path = self._path(url_grib2, br)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += len(data)
+
+        return data
+
+    def put(self, url_grib2, br, data):
+        """cache the message, written to a temporary file and renamed so readers never see a partial file.
+        a message cached already, i.e., downloaded by two workers at the same time, is written once"""
+        path = self._path(url_grib2, br)
+        if path.exists():
+            return
+        path.parent.mkdir(exist_ok=True)
+        fd, path_tmp = tempfile.mkstemp(dir=path.parent, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            n_bytes_replaced = path.stat().st_size
+        except FileNotFoundError:
+            n_bytes_replaced = 0
+        os.replace(path_tmp, path)
+
+        with self._lock:
+            self.n_bytes += len(data) - n_bytes_replaced
+            evict = self.n_bytes > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """remove the least recently used messages until the cache is at 90% of max_bytes"""
+        lst_file = []
+        for p in self._files():
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            lst_file.append((st.st_mtime, st.st_size, p))
+        lst_file.sort()
+
+        n_bytes = sum(size for (_, size, _) in lst_file)
+        for (_, size, p) in lst_file:
+            if n_bytes <= 0.9*self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            n_bytes -= size
+
+        with self._lock:
+            self.n_bytes = n_bytes
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved, "n_bytes": self.n_bytes}
+
+
+# shared by all grib2data objects of this process, None if the cache is not enabled
+cache_bytes = byte_cache(cache_bytes_dir) if cache_bytes_dir else None
@@ -0,0 +1,67 @@
+"""process-wide cache of decoded variables, so that a message used by several
+grib2 files, e.g., snowfall of forecast hour N-1 used by forecast hour N,
+is only downloaded and decoded once"""
+from utils import cache_fields_max_bytes
+from collections import OrderedDict
+from threading import Lock
+
+
+class field_cache(object):
+    """LRU cache of decoded values, keyed by (url_grib2, var_num, grid key),
+    bounded by the total number of bytes of the cached arrays"""
+    def __init__(self, max_bytes=cache_fields_max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._d = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._d
+
+    def __len__(self):
+        return len(self._d)
+
+    def get(self, key):
+        """return the cached values of key, None if it is not cached"""
+        with self._lock:
+            values = self._d.get(key)
+            if values is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._d.move_to_end(key)
+            return values
+
+    def put(self, key, values):
+        """cache values under key, the least recently used values are evicted
+        until the cache fits in max_bytes. values are made read-only as they are shared"""
+        if values.nbytes > self.max_bytes:
+            return
+        values.flags.writeable = False
+        with self._lock:
+            if key in self._d:
+                self.n_bytes -= self._d.pop(key).nbytes
+            self._d[key] = values
+            self.n_bytes += values.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, values_evicted = self._d.popitem(last=False)
+                self.n_bytes -= values_evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        """counters of the cache as a dict"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "n_fields": len(self._d), "n_bytes": self.n_bytes}
+
+
+# shared by all grib2data objects of this process
+cache_fields = field_cache()
@@ -1,8 +1,11 @@
 """use the cross section function to generate a list of index
 that represents the territory of OGE
-output the unique grid id that has premise associated"""
+output the unique grid id that has premise associated,
+as a CSV and as a binary grid index, see grid_index"""
 import pygrib
-from utils import dict_var_index, cross_section_df, box, work_dir, get_hrrr_ver, regex_local
+from utils import dict_var_index, box, work_dir, get_hrrr_ver, regex_local
+from grid_index import write_grid_index, lst_grid_def_keys
+from numpy import flatnonzero
 import pandas as pd
 import pickle
 import re
@@ -19,13 +22,13 @@ if __name__ == "__main__":
     grb_temperature_2m = grbs[index_temperature_2m]
 
     # lat and lon matrices
-    lat, lon = grb_temperature_2m.latlons()[0], grb_temperature_2m.latlons()[1]
+    lat, lon = grb_temperature_2m.latlons()
+    dict_grid_def = {key: grb_temperature_2m[key] for key in lst_grid_def_keys}
 
-    df = pd.DataFrame({"lat": lat.flatten(), "lon": lon.flatten()})
-    df2 = cross_section_df(df, box)
     # hrrr_id is the id in the HRRR model, there are about 2 million points in the HRRR model
-    df2 = df2.reset_index()
-    df2 = df2.rename(columns={"index":"hrrr_id"})
+    lat_south, lat_north, lon_west, lon_east = box
+    hrrr_id = flatnonzero((lat>=lat_south) & (lat<=lat_north) & (lon>=lon_west) & (lon<=lon_east))
+    df2 = pd.DataFrame({"hrrr_id": hrrr_id, "lat": lat.ravel()[hrrr_id], "lon": lon.ravel()[hrrr_id]})
     # grid_id is the id in the OGE territory
     df2 = df2.reset_index()
     df2 = df2.rename(columns={"index":"grid_id"})
@@ -35,4 +38,5 @@ if __name__ == "__main__":
     df_grid_unique = df_premise_peters.rename(columns={"PETER_ID":"grid_id"})["grid_id"].drop_duplicates()
 
     df_grid_unique2 = pd.merge(df2, df_grid_unique, on="grid_id")
-    df_grid_unique2.to_csv(f"{work_dir}/data_GIS/unique_grid_id.csv", index=False)
\ No newline at end of file
+    df_grid_unique2.to_csv(f"{work_dir}/data_GIS/unique_grid_id.csv", index=False)
+    write_grid_index(f"{work_dir}/data_GIS/unique_grid_id", lat, lon, df_grid_unique2["hrrr_id"].values, dict_grid_def)
\ No newline at end of file
@@ -1,46 +1,161 @@
-from utils import dttm_format, get_hrrr_ver
-import tempfile
-import requests
-import xarray as xr
+from utils import dttm_format, range_gap_max, output_format, output_compression, upload_max_concurrency, http_pool_size
+import transport
+import eccodes
 from datetime import datetime, timedelta
-from numpy import array, where
+from numpy import asarray, float32, intp, nan, where, zeros
 from pathlib import Path
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import re
-from utils import dict_var_index
+from utils import dict_var_index, dict_var_name, output_columns, output_derived
+from utils import unit_mps_mph, Kelvin_to_Fahrenheit, str_local_timestamp, wind_direction, wind_direction_desc
+from field_cache import cache_fields
+from byte_cache import cache_bytes
+from mirrors import source_mirrors
+from metrics import recorder
+from idx_store import store_idx, find_var_num
+from grid_index import lst_grid_def_keys
 import pandas as pd
 import uuid
+import hashlib
+from io import BytesIO
+import warnings
 
 # regex string to extract analysis date, analysis hour and valid hour from url_grib2
 rs_url_grib2 = r".*hrrr.(\d{8})/conus/hrrr.t(\d{2})z.wrfsfcf(\d{2}).grib2"
 
-
-# create a dict with mapping between var_num and its byte range
-# the last variable has range as range_start-;
-# the other variables have range as range_start-range_end;
-# this dict is going to be used for all variables
-def get_var_br(idx):
-    """Get byte range for variables
-    input: idx / list
-    output: OrderedDict of variables to their byte ranges"""
-    d = OrderedDict()
-    for (i,j) in zip(idx, idx[1:]+[None]):
-        var_num, range_start, _, var_name, var_desc, _, _ = i.split(':')
-        var_num, var_desc = int(var_num), f"{var_name}: {var_desc}"
-        if var_num < len(idx):
-            range_end = j.split(':')[1]
+# output columns -> variable in utils.dict_var_index and utils.dict_var_name,
+# CAPE255 uses a different variable for forecast hours 00, 01 and 02+
+dict_column_var = OrderedDict([("temperature", "temperature_2m"),
+                               ("wind_10m_u", "wind_10m_u"),
+                               ("wind_10m_v", "wind_10m_v"),
+                               ("wind_10m", "wind_10m"),
+                               ("precipitation_tot", "precipitation_tot"),
+                               ("snowfall_tot", "snowfall_tot"),
+                               ("freezing_rain", "freezing_rain"),
+                               ("composite_reflectivity", "composite_reflectivity"),
+                               ("wind_gust", "wind_gust"),
+                               ("CAPE255", None),
+                               ("helicity", "helicity"),
+                               ("lightning", "lightning")])
+
+# columns accumulated since the analysis hour in forecast hours 2+,
+# they are de-accumulated with the values of the previous forecast hour
+lst_accumulated = ["snowfall_tot", "freezing_rain"]
+
+# output format -> (folder in the container, file extension)
+dict_output_format = {"csv": ("CSV", ".csv"),
+                      "parquet": ("PARQUET", ".parquet"),
+                      "arrow": ("ARROW", ".arrow")}
+
+
+def plan_byte_ranges(var_nums, dict_var_br, gap_max=range_gap_max):
+    """merge the byte ranges of several variables into as few ranges as possible.
+    two ranges are merged if the number of bytes between them is at most gap_max,
+    the bytes in between are downloaded and thrown away.
+    input: var_nums / list of int, dict_var_br / OrderedDict from get_var_br, gap_max / int
+    output: list of (range_start, range_end, var_nums) with range_end None for the end of the file"""
+    lst_br = []
+    for var_num in sorted(set(var_nums)):
+        range_start, range_end = dict_var_br[var_num][0].split('-')
+        lst_br.append((int(range_start), int(range_end) if range_end else None, var_num))
+    lst_br.sort(key=lambda x: x[0])
+
+    plan = []
+    for (range_start, range_end, var_num) in lst_br:
+        # range_end is inclusive, adjacent messages have no bytes between them
+        if plan and plan[-1][1] is not None and range_start - plan[-1][1] - 1 <= gap_max:
+            plan[-1][1] = range_end
+            plan[-1][2].append(var_num)
         else:
-            range_end = ''
-        d[int(var_num)] = (f"{range_start}-{range_end}", var_desc)
-    
-    return d
+            plan.append([range_start, range_end, [var_num]])
+
+    return [tuple(p) for p in plan]
+
+
+def fetch_messages(url_grib2, var_nums, dict_var_br, gap_max=range_gap_max):
+    """download the messages of several variables with one request per merged byte range,
+    messages in the byte cache are read from it instead, and the others from the fastest mirror, see mirrors
+    input: url_grib2 / str, var_nums / list of int, dict_var_br / OrderedDict, gap_max / int
+    output: dict of var_num to the bytes of its message, TypeError is raised if url_grib2 is not found"""
+    dict_msg = {}
+    if cache_bytes is not None:
+        for var_num in set(var_nums):
+            msg = cache_bytes.get(url_grib2, dict_var_br[var_num][0])
+            if msg is not None:
+                dict_msg[var_num] = msg
+        var_nums = [var_num for var_num in var_nums if var_num not in dict_msg]
+
+    for (range_start, range_end, lst_var_num) in plan_byte_ranges(var_nums, dict_var_br, gap_max):
+        if source_mirrors is not None:
+            resp = source_mirrors.get(url_grib2, range_start, range_end)
+        else:
+            resp = transport.get(url_grib2, range_start, range_end)
+        if resp.status_code == 404:
+            raise TypeError
+        resp.raise_for_status()
+
+        # split the payload back into one buffer per message
+        for var_num in lst_var_num:
+            var_start, var_end = dict_var_br[var_num][0].split('-')
+            offset_start = int(var_start) - range_start
+            offset_end = int(var_end) - range_start + 1 if var_end else None
+            dict_msg[var_num] = resp.content[offset_start:offset_end]
+            if cache_bytes is not None:
+                cache_bytes.put(url_grib2, dict_var_br[var_num][0], dict_msg[var_num])
+
+    return dict_msg
+
+
+def decode_message(msg, indices=None):
+    """decode one grib2 message in memory
+    input: msg / bytes, indices / array of int: flat grid indices to keep, None for the whole grid
+    output: float32 array of the values in the order of the grid, missing values are nan"""
+    with recorder.span("decode", bytes=len(msg)):
+        gid = eccodes.codes_new_from_message(msg)
+        try:
+            values = eccodes.codes_get_values(gid)
+            value_missing = eccodes.codes_get(gid, "missingValue") if eccodes.codes_get(gid, "bitmapPresent") else None
+        finally:
+            eccodes.codes_release(gid)
+
+    with recorder.span("gather"):
+        if indices is not None:
+            values = values[indices]
+        values = values.astype(float32)
+        if value_missing is not None:
+            values[values == value_missing] = nan
+
+    return values
+
+
+def get_grid_def(msg):
+    """grid definition of one grib2 message, the keys of grid_index.lst_grid_def_keys"""
+    gid = eccodes.codes_new_from_message(msg)
+    try:
+        return {key: eccodes.codes_get(gid, key) for key in lst_grid_def_keys}
+    finally:
+        eccodes.codes_release(gid)
+
+
+def get_url_grid_def(lst_url_grib2):
+    """grid definition of the first message of the first grib2 file of lst_url_grib2 that exists,
+    None if none of them exists"""
+    for url_grib2 in lst_url_grib2:
+        try:
+            entry_idx = store_idx.get(f"{url_grib2}.idx")
+            return get_grid_def(fetch_messages(url_grib2, [1], entry_idx["dict_var_br"])[1])
+        except TypeError:
+            continue
+
+    return None
 
 
 def get_url_grib2_relative(url_grib2):
     """get relative path of url_grib2 in the container"""
     relative_blob_url = ''
     if "noaahrrr.blob.core.windows.net" not in url_grib2:
-        rs = r"https.*hrrrdata/(.*)"
+        rs = r"https?.*hrrrdata/(.*)"
         relative_blob_url = re.findall(rs, url_grib2)[0]
     else:
         rs = r"https://noaahrrr.blob.core.windows.net/hrrr/(.*)"
@@ -70,14 +185,67 @@ def timestamp_to_url(timestamp, hour_forecast, url_root):
     return url_output
 
 
+def get_df_columnar(df):
+    """df with the types of the columnar formats: float32 values, int32 hrrr_id
+    and the strings, i.e., the timestamps which are the same on every row, dictionary encoded"""
+    df = df.astype({column: float32 for column in df.columns if df[column].dtype.kind == 'f'})
+    if "hrrr_id" in df.columns:
+        df["hrrr_id"] = df["hrrr_id"].astype("int32")
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype("category")
+
+    return df
+
+
+def get_grid_key(arr_unique_grid):
+    """key of the grid points in field_cache, arr_unique_grid / intp array"""
+    return hashlib.sha1(arr_unique_grid.tobytes()).hexdigest()
+
+
+def serialize_df(df, f, output_format, output_compression):
+    """write df in output_format to f, a file name or a binary file object"""
+    if output_format == "parquet":
+        get_df_columnar(df).to_parquet(f, engine="pyarrow", index=False, compression=output_compression)
+    elif output_format == "arrow":
+        # arrow IPC file, a.k.a. feather v2
+        get_df_columnar(df).to_feather(f, compression=output_compression)
+    else:
+        df.to_csv(f, index=False)
+
+
 class grib2data(object):
     """based on url_grib2 and grids, construct an object that contains relevant data of this grib2 file"""
-    def __init__(self, url_grib2, lst_unique_grid):
+    def __init__(self, url_grib2, lst_unique_grid, gap_max=range_gap_max,
+                 output_format=output_format, output_compression=output_compression, columns=output_columns,
+                 derived=output_derived, grid_key=None):
         self.url_grib2 = url_grib2
+        # output columns, None for all columns of dict_column_var, and whether to append the derived columns
+        self.columns = list(columns or dict_column_var)
+        self.derived = derived
         self.lst_unique_grid = lst_unique_grid
+        # flat grid indices used to gather lst_unique_grid from a decoded message,
+        # not a copy if lst_unique_grid is an intp array already, see make_grib2data
+        self.arr_unique_grid = asarray(lst_unique_grid, dtype=intp)
+        # decoded values are cached per grid, see field_cache, grid_key is given when many objects share the grid
+        self.grid_key = grid_key or get_grid_key(self.arr_unique_grid)
         self.df = pd.DataFrame()
-        # to name output dataframe
-        self.df_fname = f"/tmp/df_{uuid.uuid4()}.csv"
+        # to name output dataframe, output_compression is used by parquet and arrow only
+        self.output_format = output_format
+        self.output_compression = output_compression
+        self.df_fname = f"/tmp/df_{uuid.uuid4()}{dict_output_format[self.output_format][1]}"
+        # size and sha256 of the uploaded output, set by upload_blob
+        self.output_nbytes = None
+        self.output_sha256 = None
+        # messages downloaded by fetch_vars, (url_grib2, var_num) -> bytes
+        self.gap_max = gap_max
+        self.dict_msg = {}
+        # set by fetch, see get_fields
+        self.fields = None
+        # values of the previous forecast hour given by grib2run, (url_grib2, var_num) -> values,
+        # and the accumulated values of this file kept by get_vars for the next forecast hour
+        self.dict_values_prev_h = {}
+        self.dict_values_accum = {}
 
         self.url_idx = f"{self.url_grib2}.idx"
         self.analysis_date_str, self.analysis_hour_str, self.valid_hour_str = \
@@ -91,24 +259,30 @@ class grib2data(object):
         self.valid_dttm = self.analysis_dttm + timedelta(hours=self.valid_hour)
         self.valid_dttm_str = self.valid_dttm.strftime(dttm_format)
         
-        # get index for url_grib2
-        try:
-            r = requests.get(self.url_idx)
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
-
-        self.idx = None
-        if r.status_code == 200:
-            self.idx = r.text.splitlines()
-        elif r.status_code == 404:
-            raise TypeError
+        # the index of url_grib2 is fetched on first use, see entry_idx
+        self._entry_idx = None
 
-        self.n_vars = len(self.idx)
-        self.version_hrrr = get_hrrr_ver(self.valid_hour_str, self.n_vars)
+        self.url_root = get_url_root(self.url_grib2)
 
-        self.dict_var_br = get_var_br(self.idx)
+    @property
+    def entry_idx(self):
+        """index of url_grib2 from idx_store, raises TypeError if the grib2 file does not exist"""
+        if self._entry_idx is None:
+            self._entry_idx = store_idx.get(self.url_idx)
 
-        self.url_root = get_url_root(self.url_grib2)
+        return self._entry_idx
+
+    @property
+    def n_vars(self):
+        return self.entry_idx["n_vars"]
+
+    @property
+    def version_hrrr(self):
+        return self.entry_idx["version_hrrr"]
+
+    @property
+    def dict_var_br(self):
+        return self.entry_idx["dict_var_br"]
 
     def __str__(self):
         return f"{self.url_grib2} : {self.version_hrrr}"
@@ -120,163 +294,204 @@ class grib2data(object):
         input: var_num / int: variable index in HRRR, starting with 1
         output: a list of values for this variable for only grid_id with OGE assets"""
         if var_num != 0:
-            # create tmp file for this var_num and generate its values
-            file_tmp = tempfile.NamedTemporaryFile(prefix=f"tmp_{var_num}_", delete=False)
-            headers = {"Range":f"bytes={dict_var_br[var_num][0]}"}
-            try:
-                resp = requests.get(url_grib2, headers=headers, stream=True)
-            except requests.exceptions.RequestException as e:
-                raise SystemExit(e)
-
-            file_tmp.write(resp.content)
-            file_tmp.close()
-            ds = xr.open_dataset(file_tmp.name, engine='cfgrib', backend_kwargs={'indexpath':''})
-            df_tmp = ds.to_dataframe().reset_index()
-            Path(file_tmp.name).unlink()
-            values = df_tmp.iloc[:,-1].values[self.lst_unique_grid]
+            if (url_grib2, var_num) in self.dict_values_prev_h:
+                return self.dict_values_prev_h[(url_grib2, var_num)]
+
+            values = cache_fields.get((url_grib2, var_num, self.grid_key))
+            if values is not None:
+                return values
+
+            # the message is normally downloaded by fetch_vars already
+            if (url_grib2, var_num) not in self.dict_msg:
+                self.dict_msg[(url_grib2, var_num)] = \
+                    fetch_messages(url_grib2, [var_num], dict_var_br, self.gap_max)[var_num]
+
+            values = decode_message(self.dict_msg[(url_grib2, var_num)], self.arr_unique_grid)
+            cache_fields.put((url_grib2, var_num, self.grid_key), values)
         else:
             # this variable is not present in the grib2 file
-            values = array([0]*len(self.lst_unique_grid))
+            values = zeros(len(self.arr_unique_grid), dtype=float32)
 
         return values
 
+    def get_var_num(self, var, entry_idx, hour_forecast):
+        """message number of var in the grib2 file of entry_idx, looked up by name in its idx,
+        or by position in the known versions of HRRR if the name is not found.
+        input: var / key of dict_var_name, entry_idx / from idx_store, hour_forecast / int
+        output: var_num, 0 if the variable is not in the grib2 file"""
+        var_num = find_var_num(entry_idx["dict_var_name"], dict_var_name[var], hour_forecast)
+        if var_num == 0:
+            var_num = dict_var_index[var].get(entry_idx["version_hrrr"], 0)
+            if entry_idx["version_hrrr"] not in dict_var_index[var]:
+                warnings.warn(f"{var} not found in {self.url_grib2} nor its dependencies, its values are set to 0")
+
+        return var_num
+
+    def get_url_grib2_b(self):
+        """previous analysis hour + forecast 1 hour, it has the accumulated variables of valid hour 0"""
+        return timestamp_to_url(self.analysis_dttm_prev_h, "01", get_url_root(self.url_grib2))
+
+    def get_url_grib2_prev_h(self):
+        """same analysis date and analysis hour, but previous forecast hour"""
+        return self.url_grib2.replace(f"wrfsfcf{self.valid_hour_str}", f"wrfsfcf{self.valid_hour-1:02}")
+
+    def get_url_deps(self):
+        """all grib2 files whose messages are needed by the output columns, url_grib2 first"""
+        lst_url_grib2 = [self.url_grib2]
+        if self.valid_hour == 0 and set(self.columns) & set(["precipitation_tot"] + lst_accumulated):
+            lst_url_grib2.append(self.get_url_grib2_b())
+        elif self.valid_hour >= 2 and set(self.columns) & set(lst_accumulated):
+            lst_url_grib2.append(self.get_url_grib2_prev_h())
+
+        return lst_url_grib2
+
+    def get_field(self, column):
+        """messages of one output column, see get_fields"""
+        url_grib2, dict_var_br, entry_idx = self.url_grib2, self.dict_var_br, self.entry_idx
+
+        if column in ["precipitation_tot"] + lst_accumulated:
+            if self.valid_hour == 0:
+                # use precipitation, snowfall, freezing rain and helicity
+                # from previous analysis hour and forecast 1 hour as data 
+                # for valid hour 0
+                # use _b to indicate the previous analysis hour + forecast 1 hour
+                url_grib2_b = self.get_url_grib2_b()
+                url_idx_b = f"{url_grib2_b}.idx"
+                # the blob name supplied to the get_blob_client is relevent, i.e., GRIB2/hrrr.
+                # local_blob_url = get_url_grib2_relative(self.url_grib2)
+                entry_idx_b = store_idx.get(url_idx_b)
+
+                return [(url_grib2_b, self.get_var_num(column, entry_idx_b, 1), entry_idx_b["dict_var_br"])]
+            elif self.valid_hour == 1:
+                # valid hour 1 has data for precipitation snowfall and freezing rain for hour 0-1
+                return [(url_grib2, self.get_var_num(column, entry_idx, 1), dict_var_br)]
+            elif column == "precipitation_tot":
+                # for hour 2 and forward, precipitation has the data for (valid_hour-1) to valid_hour.
+                return [(url_grib2, self.get_var_num("precipitation_tot_past_h", entry_idx, self.valid_hour), dict_var_br)]
+            else:
+                # but for snowfall and freezing rain, it has data for hour 0 to valid_hour, so the past hour data is
+                # calculated as the difference: (0 to valid_hour) - (0 to (valid_hour-1))
+                valid_prev_h = self.valid_hour - 1
+                url_grib2_prev_h = self.get_url_grib2_prev_h()
+                url_idx_prev_h = f"{url_grib2_prev_h}.idx"
+                entry_idx_prev_h = store_idx.get(url_idx_prev_h)
+
+                return [(url_grib2, self.get_var_num(column, entry_idx, self.valid_hour), dict_var_br),
+                        (url_grib2_prev_h, self.get_var_num(column, entry_idx_prev_h, valid_prev_h),
+                         entry_idx_prev_h["dict_var_br"])]
+
+        if column == "CAPE255":
+            # CAPE has different index for forecast hour 00, 01 and hours 02+
+            var = "CAPE255_h00_h01" if self.valid_hour < 2 else "CAPE255_h02plus"
+        else:
+            var = dict_column_var[column]
+
+        return [(url_grib2, self.get_var_num(var, entry_idx, self.valid_hour), dict_var_br)]
+
+    def get_fields(self):
+        """map every output column to the messages it is computed from.
+        output: OrderedDict of column -> list of (url_grib2, var_num, dict_var_br).
+        a column with one message takes its values as they are,
+        a column with two messages is the difference of the first and the second"""
+        fields = OrderedDict()
+        for column in self.columns:
+            fields[column] = self.get_field(column)
+
+        return fields
+
+    def fetch_vars(self, fields):
+        """download all messages needed by fields, adjacent messages of the same
+        grib2 file are downloaded together, see plan_byte_ranges
+        input: fields / OrderedDict from get_fields"""
+        dict_url = OrderedDict()
+        for lst_msg in fields.values():
+            for (url_grib2, var_num, dict_var_br) in lst_msg:
+                if var_num != 0 and (url_grib2, var_num) not in self.dict_msg and \
+                        (url_grib2, var_num) not in self.dict_values_prev_h and \
+                        (url_grib2, var_num, self.grid_key) not in cache_fields:
+                    dict_url.setdefault(url_grib2, (dict_var_br, []))[1].append(var_num)
+
+        for url_grib2, (dict_var_br, var_nums) in dict_url.items():
+            for var_num, msg in fetch_messages(url_grib2, var_nums, dict_var_br, self.gap_max).items():
+                self.dict_msg[(url_grib2, var_num)] = msg
+
+    def fetch(self):
+        """download all messages needed by get_vars, so that the download
+        and the decoding of a grib2 file can run in different workers"""
+        self.fields = self.get_fields()
+        self.fetch_vars(self.fields)
+
     def get_vars(self):
         """get values for all variables"""
-        index_temperature_2m = dict_var_index["temperature_2m"][self.version_hrrr]
-        index_wind_10m_u = dict_var_index["wind_10m_u"][self.version_hrrr]
-        index_wind_10m_v = dict_var_index["wind_10m_v"][self.version_hrrr]
-        index_wind_10m = dict_var_index["wind_10m"][self.version_hrrr]
-        index_composite_reflectivity = dict_var_index["composite_reflectivity"][self.version_hrrr]
-        index_wind_gust = dict_var_index["wind_gust"][self.version_hrrr]
-        index_helicity = dict_var_index["helicity"][self.version_hrrr]
-        index_lightning = dict_var_index["lightning"][self.version_hrrr]
-
-        values_temperature_2m = self.get_one_var(self.url_grib2, index_temperature_2m, self.dict_var_br)
-        values_wind_10m_u = self.get_one_var(self.url_grib2, index_wind_10m_u, self.dict_var_br)
-        values_wind_10m_v = self.get_one_var(self.url_grib2, index_wind_10m_v, self.dict_var_br)
-        values_wind_10m = self.get_one_var(self.url_grib2, index_wind_10m, self.dict_var_br)
-        values_composite_reflectivity = self.get_one_var(self.url_grib2, index_composite_reflectivity, self.dict_var_br)
-        values_wind_gust = self.get_one_var(self.url_grib2, index_wind_gust, self.dict_var_br)
-        values_helicity = self.get_one_var(self.url_grib2, index_helicity, self.dict_var_br)
-        values_lightning = self.get_one_var(self.url_grib2, index_lightning, self.dict_var_br)
-
-        # initialize timestamp dependent index
-        index_precipitation = 0 # for forecast hours 0 and 1
-        index_precipitation_past_h = 0 # for forecast hours other than 0 and 1
-        index_snowfall = 0
-        index_freezerain = 0
-        index_CAPE255 = 0
-
-        if self.valid_hour == 0:
-            # use precipitation, snowfall, freezing rain and helicity
-            # from previous analysis hour and forecast 1 hour as data 
-            # for valid hour 0
-            # use _b to indicate the previous analysis hour + forecast 1 hour
-            url_grib2_b = timestamp_to_url(self.analysis_dttm_prev_h, "01", get_url_root(self.url_grib2))
-            url_idx_b = f"{url_grib2_b}.idx"
-            # the blob name supplied to the get_blob_client is relevent, i.e., GRIB2/hrrr.
-            # local_blob_url = get_url_grib2_relative(self.url_grib2)
+        self.assemble(self.get_values())
+
+    def get_values(self):
+        """decoded values of the output columns
+        output: OrderedDict of column -> float32 array in the order of lst_unique_grid"""
+        if self.fields is None:
+            self.fetch()
+
+        dict_values = OrderedDict()
+        for column, lst_msg in self.fields.items():
+            values = self.get_one_var(*lst_msg[0])
+            # forecast hour 1 also keeps precipitation, its accumulated values are those of
+            # valid hour 0 of the next analysis hour, see get_field
+            if (column in lst_accumulated or column == "precipitation_tot" and self.valid_hour == 1) and \
+                    lst_msg[0][0] == self.url_grib2:
+                self.dict_values_accum[lst_msg[0][:2]] = values
+            if len(lst_msg) == 2:
+                # accumulated since the analysis hour, keep only the past hour
+                values = values - self.get_one_var(*lst_msg[1])
+                values = where(values<0, 0.0, values)
+            dict_values[column] = values
+        self.dict_msg = {}
+
+        return dict_values
+
+    def assemble(self, dict_values):
+        """assemble the values of the output columns into one df"""
+        with recorder.span("assemble", url=self.url_grib2):
+            self.df = pd.DataFrame({"timestamp_analysis": self.analysis_dttm_str,
+                                    "timestamp_valid": self.valid_dttm_str,
+                                    **dict_values,
+                                    "hrrr_id": self.lst_unique_grid
+                                    })
+            if self.derived:
+                self.add_derived()
+
+    def add_derived(self):
+        """append the columns derived from the variables, computed on whole columns at once:
+        wind direction in degrees and its sector, wind speed in mph, temperature in F
+        and the local valid timestamp, which is computed once as it is the same on every row"""
+        if "wind_10m_u" in self.df.columns and "wind_10m_v" in self.df.columns:
+            self.df["wind_direction"] = wind_direction(self.df["wind_10m_u"].values, self.df["wind_10m_v"].values)
+            self.df["wind_direction_desc"] = wind_direction_desc(self.df["wind_direction"].values)
+        if "wind_10m" in self.df.columns:
+            self.df["wind_10m_mph"] = self.df["wind_10m"].values*float32(unit_mps_mph)
+        if "temperature" in self.df.columns:
+            self.df["temperature_F"] = Kelvin_to_Fahrenheit(self.df["temperature"].values)
+        self.df["timestamp_valid_local"] = str_local_timestamp(self.valid_dttm_str)
+    
+    def get_df_columnar(self):
+        """the df with the types of the columnar formats, see get_df_columnar"""
+        return get_df_columnar(self.df)
 
-            try:
-                r = requests.get(url_idx_b)
-            except requests.exceptions.RequestException as e:
-                raise SystemExit(e)
-
-            idx_b = None
-            if r.status_code == 200:
-                idx_b = r.text.splitlines()
-            elif r.status_code == 404:
-                raise TypeError
-
-            dict_var_br_b = get_var_br(idx_b)
-            version_hrrr_b = get_hrrr_ver("01", len(idx_b))
-
-            index_precipitation_b = dict_var_index["precipitation_tot"][version_hrrr_b]
-            index_snowfall_b = dict_var_index["snowfall_tot"][version_hrrr_b]
-            index_freezerain_b = dict_var_index["freezing_rain"][version_hrrr_b]
-
-            # values
-            values_precipitation = self.get_one_var(url_grib2_b, index_precipitation_b, dict_var_br_b)
-            values_snowfall = self.get_one_var(url_grib2_b, index_snowfall_b, dict_var_br_b)
-            values_freezerain = self.get_one_var(url_grib2_b, index_freezerain_b, dict_var_br_b)
-
-            index_CAPE255 = dict_var_index["CAPE255_h00_h01"][self.version_hrrr]
-            values_cape = self.get_one_var(self.url_grib2, index_CAPE255, self.dict_var_br)
-        elif self.valid_hour == 1:
-            # valid hour 1 has data for precipitation snowfall and freezing rain for hour 0-1
-            index_precipitation = dict_var_index["precipitation_tot"][self.version_hrrr]
-            index_snowfall = dict_var_index["snowfall_tot"][self.version_hrrr]
-            index_freezerain = dict_var_index["freezing_rain"][self.version_hrrr]
-
-            index_CAPE255 = dict_var_index["CAPE255_h00_h01"][self.version_hrrr]
-
-            values_precipitation = self.get_one_var(self.url_grib2, index_precipitation, self.dict_var_br)
-            values_snowfall = self.get_one_var(self.url_grib2, index_snowfall, self.dict_var_br)
-            values_freezerain = self.get_one_var(self.url_grib2, index_freezerain, self.dict_var_br)
-
-            values_cape = self.get_one_var(self.url_grib2, index_CAPE255, self.dict_var_br)
-        elif self.valid_hour >= 2:
-            # for hour 2 and forward, precipitation has the data for (valid_hour-1) to valid_hour.
-            # but for snowfall and freezing rain, it has data for hour 0 to valid_hour, so the past hour data is
-            # calculated as the difference: (0 to valid_hour) - (0 to (valid_hour-1))
-            valid_prev_h = int(self.valid_hour_str) - 1
-            valid_prev_h_str = f"{valid_prev_h:02}"
-
-            index_precipitation_past_h = dict_var_index["precipitation_tot_past_h"][self.version_hrrr]
-            index_snowfall = dict_var_index["snowfall_tot"][self.version_hrrr]
-            index_freezerain = dict_var_index["freezing_rain"][self.version_hrrr]
+    def serialize(self, f):
+        """write the df in output_format to f, a file name or a binary file object"""
+        with recorder.span("serialize", url=self.url_grib2, output_format=self.output_format):
+            serialize_df(self.df, f, self.output_format, self.output_compression)
 
-            # CAPE has different index for forecast hour 00, 01 and hours 02+
-            index_CAPE255 = dict_var_index["CAPE255_h02plus"][self.version_hrrr]
+    def to_buffer(self):
+        """the serialized df in memory"""
+        buffer = BytesIO()
+        self.serialize(buffer)
+        buffer.seek(0)
 
-            # same analysis date and analysis hour, but previous forecast hour
-            url_grib2_prev_h = self.url_grib2.replace(f"wrfsfcf{self.valid_hour_str}", f"wrfsfcf{valid_prev_h_str}")
-            url_idx_prev_h = f"{url_grib2_prev_h}.idx"
+        return buffer
 
-            try:
-                r = requests.get(url_idx_prev_h)
-            except requests.exceptions.RequestException as e:
-                raise SystemExit(e)
-            
-            idx_prev_h = None
-            if r.status_code == 200:
-                idx_prev_h = r.text.splitlines()
-            elif r.status_code == 404:
-                raise TypeError
-
-            dict_var_br_prev_h = get_var_br(idx_prev_h)
-
-            values_snowfall = self.get_one_var(self.url_grib2, index_snowfall, self.dict_var_br) - \
-                              self.get_one_var(url_grib2_prev_h, index_snowfall, dict_var_br_prev_h)
-            values_snowfall = where(values_snowfall<0, 0.0, values_snowfall)
-            values_freezerain = self.get_one_var(self.url_grib2, index_freezerain, self.dict_var_br) - \
-                                self.get_one_var(url_grib2_prev_h, index_freezerain, dict_var_br_prev_h)
-            values_freezerain = where(values_freezerain<0, 0.0, values_freezerain)
-
-            values_precipitation = self.get_one_var(self.url_grib2, index_precipitation_past_h, self.dict_var_br)
-            values_cape = self.get_one_var(self.url_grib2, index_CAPE255, self.dict_var_br)
-
-        # assemble into one df
-        self.df = pd.DataFrame({"timestamp_analysis": self.analysis_dttm_str,
-                                "timestamp_valid": self.valid_dttm_str,
-                                "temperature": values_temperature_2m,
-                                "wind_10m_u": values_wind_10m_u,
-                                "wind_10m_v": values_wind_10m_v,
-                                "wind_10m": values_wind_10m,
-                                "precipitation_tot": values_precipitation,
-                                "snowfall_tot": values_snowfall,
-                                "freezing_rain": values_freezerain,
-                                "composite_reflectivity": values_composite_reflectivity,
-                                "wind_gust": values_wind_gust,
-                                "CAPE255": values_cape,
-                                "helicity": values_helicity,
-                                "lightning": values_lightning,
-                                "hrrr_id": self.lst_unique_grid
-                                })
-    
     def write_to_disk(self):
         """save the df to disk"""
-        self.df.to_csv(self.df_fname, index=False)
+        self.serialize(self.df_fname)
     
     def get_url_csv_relative(self):
         """get relative url_csv from url_grib2, i.e,:
@@ -293,11 +508,93 @@ class grib2data(object):
 
         return url_csv_relative
     
-    def upload_blob(self, container_client):
-        blob_client_csv = container_client.get_blob_client(blob=self.get_url_csv_relative())
-        with open(self.df_fname, "rb") as data:
-            blob_client_csv.upload_blob(data, overwrite=True)
+    def get_url_output_relative(self):
+        """get relative url of the output, it is get_url_csv_relative with
+        the folder and the extension of output_format, i.e,:
+        GRIB2/hrrr.20190101/conus/hrrr.t00z.wrfsfcf00.grib2 ->
+        PARQUET/hrrr.20190101/conus/hrrr.t00z.f00.parquet
+        """
+        folder, extension = dict_output_format[self.output_format]
+        url_csv_relative = self.get_url_csv_relative()
+
+        return f"{folder}{url_csv_relative[len('CSV'):-len('.csv')]}{extension}"
+    
+    def upload_blob(self, container_client, max_concurrency=upload_max_concurrency):
+        """upload the df, from disk if write_to_disk was called and from memory otherwise.
+        outputs larger than one block are uploaded in max_concurrency parallel blocks"""
+        blob_client_csv = container_client.get_blob_client(blob=self.get_url_output_relative())
+        if Path(self.df_fname).exists():
+            with open(self.df_fname, "rb") as data:
+                self.output_sha256 = hashlib.sha256(data.read()).hexdigest()
+                self.output_nbytes = data.tell()
+                data.seek(0)
+                with recorder.span("upload", blob=self.get_url_output_relative(), bytes=self.output_nbytes):
+                    blob_client_csv.upload_blob(data, overwrite=True, max_concurrency=max_concurrency)
+        else:
+            data = self.to_buffer()
+            self.output_sha256 = hashlib.sha256(data.getbuffer()).hexdigest()
+            self.output_nbytes = data.getbuffer().nbytes
+            with recorder.span("upload", blob=self.get_url_output_relative(), bytes=self.output_nbytes):
+                blob_client_csv.upload_blob(data, length=self.output_nbytes, overwrite=True,
+                                            max_concurrency=max_concurrency)
 
     def remove_from_disk(self):
         """remove df"""
-        Path(self.df_fname).unlink()
+        Path(self.df_fname).unlink(missing_ok=True)
+
+
+def make_grib2data(lst_url_grib2, lst_unique_grid, n_workers=http_pool_size, on_ready=None, **kwargs):
+    """construct grib2data of many grib2 files, the idx of the files and of their dependencies
+    are fetched concurrently, a missing idx once, so missing inputs are known before processing.
+    the fields of a file are mapped right after its idx are fetched, so they are read from idx_store
+    before its least recently used entries are dropped. all objects share one intp copy of lst_unique_grid.
+    input: on_ready / called with every grib2data whose inputs are all present and its fields from get_fields,
+    in the order of lst_url_grib2, the objects are then not kept, kwargs / passed to grib2data
+    output: lst_grib2 / grib2data of the files whose inputs are all present, in the order of lst_url_grib2,
+    empty if on_ready is given, report / dict with "missing": url_grib2 -> missing grib2 files, "failed":
+    url_grib2 -> error of the idx download, "incomplete": url_grib2 -> output columns not found in its grib2 files"""
+    arr_unique_grid = asarray(lst_unique_grid, dtype=intp)
+    grid_key = get_grid_key(arr_unique_grid)
+    # errors of the idx downloads, the idx found are in idx_store
+    dict_error = {}
+
+    def get_error(url_grib2):
+        if url_grib2 not in dict_error:
+            try:
+                store_idx.get(f"{url_grib2}.idx")
+            except Exception as e:
+                dict_error[url_grib2] = e
+
+        return dict_error.get(url_grib2)
+
+    def prepare(url_grib2):
+        grib2 = grib2data(url_grib2, arr_unique_grid, grid_key=grid_key, **kwargs)
+        lst_error = [(url, get_error(url)) for url in grib2.get_url_deps()]
+        lst_error = [(url, e) for (url, e) in lst_error if e is not None]
+        if lst_error:
+            return grib2, lst_error, None
+        fields = grib2.get_fields()
+        # the entry stays in idx_store, the object is fetched again on use
+        grib2._entry_idx = None
+
+        return grib2, lst_error, fields
+
+    lst_grib2 = []
+    report = {"missing": OrderedDict(), "failed": OrderedDict(), "incomplete": OrderedDict()}
+    with ThreadPoolExecutor(n_workers) as executor:
+        for (grib2, lst_error, fields) in executor.map(prepare, lst_url_grib2):
+            lst_missing = [url for (url, e) in lst_error if isinstance(e, TypeError)]
+            if lst_missing:
+                report["missing"][grib2.url_grib2] = lst_missing
+            elif lst_error:
+                report["failed"][grib2.url_grib2] = repr(lst_error[0][1])
+            else:
+                lst_column = [column for (column, lst_msg) in fields.items() if any(var_num == 0 for (_, var_num, _) in lst_msg)]
+                if lst_column:
+                    report["incomplete"][grib2.url_grib2] = lst_column
+                if on_ready is not None:
+                    on_ready(grib2, fields)
+                else:
+                    lst_grib2.append(grib2)
+
+    return lst_grib2, report
@@ -0,0 +1,122 @@
+"""process the forecast hours of one analysis cycle in one pass.
+forecast hour N of a cycle de-accumulates snowfall and freezing rain with forecast hour N-1,
+the run walks the hours in order and hands the accumulated values of hour N-1 to hour N,
+so they are neither downloaded nor decoded again. runs of consecutive analysis hours can be chained
+the same way: f00 takes the accumulated values of f01 of the previous analysis hour, see future_values_b.
+the outputs are written with outputs.upload_grib2, as by process_grib2_az"""
+from utils import output_format, output_compression, upload_max_concurrency, range_gap_max, output_columns, output_derived
+from grib2data import grib2data, rs_url_grib2, get_url_root, timestamp_to_url, serialize_df, get_grid_key
+from outputs import upload_grib2, write_timeseries
+from numpy import asarray, intp
+from datetime import datetime
+from io import BytesIO
+import pandas as pd
+import hashlib
+import re
+
+
+class grib2run(object):
+    """forecast hours_forecast of the analysis cycle of url_grib2, which is any grib2 file of the cycle,
+    gap_max, output_format, output_compression, columns and derived are those of its grib2data"""
+    def __init__(self, url_grib2, lst_unique_grid, hours_forecast=range(0, 19), combined=False, gap_max=range_gap_max,
+                 output_format=output_format, output_compression=output_compression, columns=output_columns,
+                 derived=output_derived, grid_key=None):
+        # the grib2data of the forecast hours share one intp copy of lst_unique_grid and its grid_key
+        self.lst_unique_grid = asarray(lst_unique_grid, dtype=intp)
+        self.grid_key = grid_key or get_grid_key(self.lst_unique_grid)
+        self.hours_forecast = sorted(hours_forecast)
+        # one output for the whole run instead of one per forecast hour,
+        # its name has the range of forecast hours, which must then be consecutive, see manifest.name_to_keys
+        self.combined = combined
+        if combined and self.hours_forecast != list(range(self.hours_forecast[0], self.hours_forecast[-1] + 1)):
+            raise ValueError(f"combined output of forecast hours {self.hours_forecast}, they are not consecutive")
+        self.gap_max = gap_max
+        self.output_format = output_format
+        self.output_compression = output_compression
+        self.columns = columns
+        self.derived = derived
+
+        analysis_date_str, analysis_hour_str, _ = re.findall(rs_url_grib2, url_grib2)[0]
+        self.analysis_dttm = datetime.strptime(f"{analysis_date_str} {analysis_hour_str}:00:00", "%Y%m%d %H:%M:%S")
+        self.url_root = get_url_root(url_grib2)
+
+        # status of every forecast hour: done, or empty if some of its inputs are missing
+        self.dict_status = {}
+        # outputs of the forecast hours when combined
+        self.lst_df = []
+        self.output_nbytes = None
+        self.output_sha256 = None
+        # accumulated values of f01 of the previous analysis hour given to f00 and of f01 of this run,
+        # concurrent.futures.Future set by the run of the previous and for the run of the next analysis hour
+        self.future_values_b = None
+        self.future_values_f01 = None
+
+    def __str__(self):
+        return f"{self.get_url_grib2(self.hours_forecast[0])} : f{self.hours_forecast[0]:02}-f{self.hours_forecast[-1]:02}"
+
+    def get_url_grib2(self, hour_forecast):
+        return timestamp_to_url(self.analysis_dttm, f"{hour_forecast:02}", self.url_root)
+
+    def get_url_output_relative(self, grib2_first):
+        """relative url of the combined output, it is the output of the first forecast hour
+        with the range of forecast hours, i.e., CSV/hrrr.20190101/conus/hrrr.t00z.f00-f18.csv"""
+        return re.sub(r"\.f(\d{2})\.(\w+)$", f".f\\1-f{self.hours_forecast[-1]:02}.\\2",
+                      grib2_first.get_url_output_relative())
+
+    def process(self, container_client, manifest_outputs=None):
+        """get the variables of every forecast hour in order and upload them,
+        one output per forecast hour, or one for the run if combined"""
+        try:
+            self.process_hours(container_client, manifest_outputs)
+        finally:
+            # the run of the next analysis hour never waits for a run which failed
+            if self.future_values_f01 is not None and not self.future_values_f01.done():
+                self.future_values_f01.set_result({})
+
+    def process_hours(self, container_client, manifest_outputs=None):
+        """the loop over the forecast hours of process"""
+        grib2_first = None
+        dict_values_accum = {}
+        for hour_forecast in self.hours_forecast:
+            grib2 = grib2data(self.get_url_grib2(hour_forecast), self.lst_unique_grid, gap_max=self.gap_max,
+                              output_format=self.output_format, output_compression=self.output_compression,
+                              columns=self.columns, derived=self.derived, grid_key=self.grid_key)
+            grib2_first = grib2_first or grib2
+            # only the accumulated values of the previous forecast hour are kept
+            if hour_forecast == 0 and self.future_values_b is not None:
+                dict_values_accum = self.future_values_b.result()
+            grib2.dict_values_prev_h = dict_values_accum
+            status = "done"
+            try:
+                grib2.get_vars()
+            except TypeError:
+                status = "empty"
+            dict_values_accum = grib2.dict_values_accum
+            self.dict_status[hour_forecast] = status
+            if hour_forecast == 1 and self.future_values_f01 is not None:
+                self.future_values_f01.set_result(dict_values_accum)
+
+            if self.combined:
+                self.lst_df.append(grib2.df)
+                write_timeseries(grib2)
+            else:
+                upload_grib2(grib2, container_client, manifest_outputs, status)
+
+        if self.combined:
+            self.upload_blob(container_client, grib2_first)
+            if manifest_outputs is not None:
+                for hour_forecast, status in self.dict_status.items():
+                    manifest_outputs.mark(grib2_first.analysis_dttm_str, hour_forecast, status,
+                                          self.get_url_output_relative(grib2_first), self.output_nbytes, self.output_sha256)
+
+    def upload_blob(self, container_client, grib2_first, max_concurrency=upload_max_concurrency):
+        """upload the outputs of all forecast hours as one blob"""
+        data = BytesIO()
+        serialize_df(pd.concat(self.lst_df, ignore_index=True), data, self.output_format, self.output_compression)
+        self.output_sha256 = hashlib.sha256(data.getbuffer()).hexdigest()
+        self.output_nbytes = data.getbuffer().nbytes
+        data.seek(0)
+
+        blob_client = container_client.get_blob_client(blob=self.get_url_output_relative(grib2_first))
+        blob_client.upload_blob(data, length=self.output_nbytes, overwrite=True, max_concurrency=max_concurrency)
+        self.lst_df = []
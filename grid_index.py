@@ -0,0 +1,63 @@
+"""binary grid index of the HRRR grid points with assets, built by gen_grid_id.py.
+it is a directory with:
+lat.npy, lon.npy: float32 (y, x) matrices of the HRRR grid
+indices.npy: int32 flat indices of the grid points with assets, i.e., lst_unique_grid
+meta.json: version, shape, (y, x) bounding window of the indices and the grid definition with its checksum
+the arrays are memory-mapped by load_grid_index, so the workers share them through the page cache"""
+from numpy import asarray, float32, int32, load, save
+from pathlib import Path
+import hashlib
+import json
+
+grid_index_version = 1
+
+# grib2 keys of the grid definition, shared by pygrib and eccodes
+lst_grid_def_keys = ["gridType", "Nx", "Ny", "latitudeOfFirstGridPointInDegrees", "longitudeOfFirstGridPointInDegrees",
+                     "LaDInDegrees", "LoVInDegrees", "Latin1InDegrees", "Latin2InDegrees", "DxInMetres", "DyInMetres"]
+
+
+def get_grid_checksum(dict_grid_def):
+    """sha256 of the grid definition, independent of the order of the keys"""
+    return hashlib.sha256(json.dumps(dict_grid_def, sort_keys=True).encode()).hexdigest()
+
+
+def write_grid_index(path, lat, lon, indices, dict_grid_def):
+    """write the grid index to the directory path
+    input: lat, lon / (y, x) arrays, indices / flat indices of the grid points with assets,
+    dict_grid_def / dict of lst_grid_def_keys to their values"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    indices = asarray(indices, dtype=int32)
+    ny, nx = lat.shape
+    y, x = indices // nx, indices % nx
+
+    save(path/"lat.npy", asarray(lat, dtype=float32))
+    save(path/"lon.npy", asarray(lon, dtype=float32))
+    save(path/"indices.npy", indices)
+    meta = {"version": grid_index_version,
+            "shape": [ny, nx],
+            "n_points": len(indices),
+            # [y_start, y_end, x_start, x_end), empty if there is no point
+            "window": [int(y.min()), int(y.max()) + 1, int(x.min()), int(x.max()) + 1] if len(indices) else [],
+            "grid_def": dict_grid_def,
+            "checksum": get_grid_checksum(dict_grid_def)}
+    with open(path/"meta.json", "w") as f:
+        json.dump(meta, f, indent=1)
+
+
+def load_grid_index(path, dict_grid_def=None):
+    """memory-map the grid index in the directory path
+    input: dict_grid_def / grid definition of the grib2 files to be processed, to check the index against
+    output: dict with lat, lon, indices and the content of meta.json"""
+    path = Path(path)
+    with open(path/"meta.json") as f:
+        meta = json.load(f)
+    if meta["version"] != grid_index_version:
+        raise ValueError(f"{path}: grid index version {meta['version']}, expected {grid_index_version}")
+    if dict_grid_def is not None and get_grid_checksum(dict_grid_def) != meta["checksum"]:
+        raise ValueError(f"{path}: grid index built for another grid definition")
+
+    return {**meta,
+            "lat": load(path/"lat.npy", mmap_mode='r'),
+            "lon": load(path/"lon.npy", mmap_mode='r'),
+            "indices": load(path/"indices.npy", mmap_mode='r')}
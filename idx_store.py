@@ -0,0 +1,174 @@
+"""download and parse the idx of a grib2 file only once.
+published HRRR idx files never change, so the parsed idx is kept in memory, up to
+cache_idx_max_entries of them, and optionally in a directory of JSON files shared by runs"""
+from utils import get_hrrr_ver, cache_idx_dir, cache_idx_max_entries
+from concurrent.futures import Future
+from collections import OrderedDict
+from threading import Lock
+from pathlib import Path
+from metrics import recorder
+import transport
+import hashlib
+import json
+import os
+import re
+
+# regex string to extract the forecast hour from url_idx
+rs_url_idx = r".*wrfsfcf(\d{2}).grib2.idx"
+
+
+# create a dict with mapping between var_num and its byte range
+# the last variable has range as range_start-;
+# the other variables have range as range_start-range_end;
+# this dict is going to be used for all variables
+def get_var_br(idx):
+    """Get byte range for variables
+    input: idx / list
+    output: OrderedDict of variables to their byte ranges"""
+    d = OrderedDict()
+    for (i,j) in zip(idx, idx[1:]+[None]):
+        var_num, range_start, _, var_name, var_desc, _, _ = i.split(':')
+        var_num, var_desc = int(var_num), f"{var_name}: {var_desc}"
+        if var_num < len(idx):
+            range_end = j.split(':')[1]
+        else:
+            range_end = ''
+        d[int(var_num)] = (f"{range_start}-{range_end}", var_desc)
+
+    return d
+
+
+def get_var_name(idx):
+    """searchable index of the variables by name
+    input: idx / list, a line is var_num:range_start:date:shortName:level:time range:
+    output: OrderedDict of (shortName, level, time range) to var_num, the first one if there are several"""
+    d = OrderedDict()
+    for i in idx:
+        var_num, _, _, short_name, level, time_range = i.split(':')[:6]
+        d.setdefault((short_name, level, time_range), int(var_num))
+
+    return d
+
+
+def find_var_num(dict_var_name, name, hour_forecast):
+    """look up a variable by name
+    input: dict_var_name / from get_var_name, name / (shortName, level, time range regex) as in utils.dict_var_name,
+    hour_forecast / int, replaces {h} and {h_prev} in the time range regex
+    output: var_num, 0 if it is not found"""
+    short_name, level, rs_time_range = name
+    rs_time_range = rs_time_range.format(h=hour_forecast, h_prev=hour_forecast-1)
+    for (short_name_i, level_i, time_range_i), var_num in dict_var_name.items():
+        if short_name_i == short_name and level_i == level and re.fullmatch(rs_time_range, time_range_i):
+            return var_num
+
+    return 0
+
+
+def get_idx(url_idx):
+    """download an idx file
+    input: url_idx / str
+    output: list of lines of the idx file, TypeError is raised if the idx is not found"""
+    r = transport.get(url_idx)
+    if r.status_code == 404:
+        raise TypeError
+    r.raise_for_status()
+
+    return r.text.splitlines()
+
+
+class idx_store(object):
+    """parsed idx files keyed by url_idx. an entry is a dict with n_vars: number of messages,
+    dict_var_br: OrderedDict from get_var_br, dict_var_name: OrderedDict from get_var_name and version_hrrr: str.
+    concurrent calls of get for the same url_idx share one download. the least recently used entries
+    over max_entries are dropped from memory, they are read again from the cache directory if there is one"""
+    def __init__(self, cache_dir=cache_idx_dir, max_entries=cache_idx_max_entries):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._d = OrderedDict()
+        self._in_flight = {}
+        self._lock = Lock()
+
+    def _path(self, url_idx):
+        return self.cache_dir/f"{hashlib.sha1(url_idx.encode()).hexdigest()}.json"
+
+    def _load(self, url_idx):
+        """entry from the cache directory, None if it is not there"""
+        if not self.cache_dir or not self._path(url_idx).exists():
+            return None
+        with open(self._path(url_idx)) as f:
+            d = json.load(f)
+
+        return {"n_vars": len(d["idx"]),
+                "dict_var_br": OrderedDict((var_num, (br, desc)) for (var_num, br, desc) in d["dict_var_br"]),
+                "dict_var_name": get_var_name(d["idx"]),
+                "version_hrrr": d["version_hrrr"]}
+
+    def _save(self, url_idx, idx, entry):
+        """write the lines idx and entry to the cache directory, the rename makes it safe for concurrent runs"""
+        if not self.cache_dir:
+            return
+        d = {"url_idx": url_idx,
+             "idx": idx,
+             "dict_var_br": [[var_num, br, desc] for (var_num, (br, desc)) in entry["dict_var_br"].items()],
+             "version_hrrr": entry["version_hrrr"]}
+        path_tmp = self._path(url_idx).with_suffix(f".{os.getpid()}.tmp")
+        with open(path_tmp, "w") as f:
+            json.dump(d, f, separators=(',', ':'))
+        os.replace(path_tmp, self._path(url_idx))
+
+    def _fetch(self, url_idx):
+        entry = self._load(url_idx)
+        if entry is None:
+            with recorder.span("idx_fetch", url=url_idx):
+                idx = get_idx(url_idx)
+            hour_forecast = re.findall(rs_url_idx, url_idx)[0]
+            # the lines are not kept once parsed
+            entry = {"n_vars": len(idx),
+                     "dict_var_br": get_var_br(idx),
+                     "dict_var_name": get_var_name(idx),
+                     "version_hrrr": get_hrrr_ver(hour_forecast, len(idx))}
+            self._save(url_idx, idx, entry)
+
+        return entry
+
+    def clear(self):
+        """forget the entries in memory, the cache directory is kept"""
+        with self._lock:
+            self._d.clear()
+
+    def get(self, url_idx):
+        """get the entry of url_idx, downloading it if needed.
+        TypeError is raised if the idx is not found, it is not cached"""
+        with self._lock:
+            if url_idx in self._d:
+                self._d.move_to_end(url_idx)
+                return self._d[url_idx]
+            future = self._in_flight.get(url_idx)
+            owner = future is None
+            if owner:
+                future = self._in_flight[url_idx] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            entry = self._fetch(url_idx)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[url_idx]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._d[url_idx] = entry
+            while len(self._d) > self.max_entries:
+                self._d.popitem(last=False)
+            del self._in_flight[url_idx]
+        future.set_result(entry)
+
+        return entry
+
+
+# shared by all grib2data objects of this process
+store_idx = idx_store()
@@ -0,0 +1,149 @@
+"""share the files to process between workers on several nodes with blob leases.
+the files are grouped in batches of lease_batch_hours analysis hours of a day, every batch
+has a lock blob LEASE/<output format>/hrrr.<date>.t<first hour>z.lock in the target container, the same
+for all workers whatever files each of them finds missing. a worker processes a batch only if it acquires
+the lease of its lock blob, renews the lease while working, and adds the files it completed to the content
+of the lock blob. after acquiring, the files still to process are the files of the worker not listed in the
+lock blob, so a batch with other files, i.e., other forecast hours or files queued again, is claimed again
+for these files only. the lease of a crashed worker expires after lease_duration seconds, and another
+worker can claim the batch. it works the same on Azurite"""
+from utils import lease_batch_hours, lease_duration, output_format
+from azure.core.exceptions import ResourceExistsError, HttpResponseError
+from collections import OrderedDict
+from threading import Event, Thread
+import re
+
+# regex string to extract analysis date and analysis hour from url_grib2
+rs_url_batch = r".*hrrr.(\d{8})/conus/hrrr.t(\d{2})z.wrfsfcf\d{2}.grib2"
+
+
+def get_batch_group(url_grib2, batch_hours=lease_batch_hours):
+    """analysis date and hours of the batch of url_grib2, the same for all workers"""
+    date, hour = re.findall(rs_url_batch, url_grib2)[0]
+
+    return f"hrrr.{date}.t{int(hour)//batch_hours*batch_hours:02}z"
+
+
+def get_batch_id(batch_group, output_format=output_format):
+    """id of the batch of batch_group written in output_format"""
+    return f"{output_format}/{batch_group}"
+
+
+class batch_lease(object):
+    """lease on the lock blob of one batch"""
+    def __init__(self, container_client, batch_id, duration=lease_duration):
+        self.batch_id = batch_id
+        self.duration = duration
+        self.blob_client = container_client.get_blob_client(blob=f"LEASE/{batch_id}.lock")
+        self.lease = None
+        self._stop = Event()
+        self._thread = None
+
+    def get_completed(self):
+        """url_grib2 of the files of the batch completed by any worker, one per line of the lock blob"""
+        return set(self.blob_client.download_blob().readall().decode().split())
+
+    def acquire(self):
+        """try to claim the batch, False if another worker holds it"""
+        try:
+            self.blob_client.upload_blob(b'', overwrite=False)
+        except ResourceExistsError:
+            pass
+        try:
+            self.lease = self.blob_client.acquire_lease(lease_duration=self.duration)
+        except HttpResponseError:
+            # 409, the lease is held by another worker
+            return False
+
+        self._stop.clear()
+        self._thread = Thread(target=self._renew, daemon=True)
+        self._thread.start()
+
+        return True
+
+    def _renew(self):
+        """renew the lease three times per lease duration until released"""
+        while not self._stop.wait(self.duration/3):
+            try:
+                self.lease.renew()
+            except HttpResponseError as e:
+                print("lease lost", self.batch_id, repr(e), flush=True)
+                return
+
+    def complete(self, lst_url_grib2):
+        """add the files lst_url_grib2 to the completed files of the batch, other workers skip them"""
+        completed = self.get_completed() | set(lst_url_grib2)
+        self.blob_client.upload_blob("\n".join(sorted(completed)).encode(), overwrite=True, lease=self.lease)
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.lease is not None:
+            try:
+                self.lease.release()
+            except HttpResponseError:
+                # the lease expired already
+                pass
+            self.lease = None
+
+
+def iter_claimed_batches(container_client, lst_url_grib2, batch_hours=lease_batch_hours, duration=lease_duration,
+                         output_format=output_format):
+    """yield (batch_lease, list of url_grib2 not completed yet) for the batches this worker claims.
+    the caller processes the urls, calls complete with the urls that succeeded, and release"""
+    dict_batch = OrderedDict()
+    for url_grib2 in lst_url_grib2:
+        dict_batch.setdefault(get_batch_group(url_grib2, batch_hours), []).append(url_grib2)
+
+    for batch_group, lst_url_batch in dict_batch.items():
+        lease = batch_lease(container_client, get_batch_id(batch_group, output_format), duration)
+        if not lease.acquire():
+            continue
+        completed = lease.get_completed()
+        lst_url_remaining = [url_grib2 for url_grib2 in lst_url_batch if url_grib2 not in completed]
+        if not lst_url_remaining:
+            print("batch done already", lease.batch_id, flush=True)
+            lease.release()
+            continue
+        yield lease, lst_url_remaining
+
+
+if __name__ == "__main__":
+    # check of the claim protocol against a local Azurite, e.g., docker run -p 10000:10000 mcr.microsoft.com/azure-storage/azurite
+    from azure.storage.blob import BlobServiceClient
+    container_client = BlobServiceClient.from_connection_string("UseDevelopmentStorage=true").get_container_client("lease-check")
+    try:
+        container_client.create_container()
+    except ResourceExistsError:
+        pass
+
+    lst_url = [f"https://noaahrrr.blob.core.windows.net/hrrr/hrrr.20210101/conus/hrrr.t{h:02}z.wrfsfcf{fh:02}.grib2"
+               for h in range(0, 12) for fh in range(0, 3)]
+    lst_claimed_a = list(iter_claimed_batches(container_client, lst_url, duration=15))
+    # the second worker sees every batch held by the first one
+    lst_claimed_b = list(iter_claimed_batches(container_client, lst_url, duration=15))
+    assert len(lst_claimed_a) == 2 and len(lst_claimed_b) == 0, (len(lst_claimed_a), len(lst_claimed_b))
+
+    # the first batch is done, the second one is released after a failure and can be claimed again
+    (lease_done, lst_url_done), (lease_failed, _) = lst_claimed_a
+    lease_done.complete(lst_url_done)
+    lease_done.release()
+    lease_failed.release()
+    lst_claimed_b = list(iter_claimed_batches(container_client, lst_url, duration=15))
+    assert [lease.batch_id for (lease, _) in lst_claimed_b] == [lease_failed.batch_id], lst_claimed_b
+    for (lease, _) in lst_claimed_b:
+        lease.release()
+
+    # another forecast hour of the done batch is claimed on the same lock, with the new files only
+    lst_url_more = lst_url + [url.replace("wrfsfcf02", "wrfsfcf03") for url in lst_url if "wrfsfcf02" in url]
+    lst_claimed_c = list(iter_claimed_batches(container_client, lst_url_more, duration=15))
+    assert len(lst_claimed_c) == 2, lst_claimed_c
+    assert lst_claimed_c[0][0].batch_id == lease_done.batch_id, lst_claimed_c
+    assert all("wrfsfcf03" in url for url in lst_claimed_c[0][1]) and len(lst_claimed_c[0][1]) == 6, lst_claimed_c
+    for (lease, _) in lst_claimed_c:
+        lease.release()
+
+    container_client.delete_container()
+    print("ok")
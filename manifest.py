@@ -0,0 +1,119 @@
+"""local SQLite manifest of the processed files, keyed by (output format, analysis datetime, forecast hour).
+finding the files still to process is a query on the manifest instead of a listing of the
+container; reconcile rebuilds the manifest from a listing when asked. a manifest object reads and
+writes the rows of its output format only, so the outputs of another format are not taken as complete"""
+from utils import dttm_format, manifest_path, output_format
+from datetime import datetime
+from threading import Lock
+import sqlite3
+import re
+
+# regex string to extract analysis date, analysis hour and forecast hour,
+# it works for both grib2 and output names, i.e., wrfsfcf00.grib2 and f00.csv
+rs_name = r".*hrrr.(\d{8}).*hrrr.t(\d{2})z.*f(\d{2})\.\w+$"
+# regex string of the combined output of a run of forecast hours, see grib2run, i.e., f00-f18.csv
+rs_name_run = r".*hrrr.(\d{8}).*hrrr.t(\d{2})z.*\.f(\d{2})-f(\d{2})\.\w+$"
+
+# statuses of a file that does not need to be processed again,
+# empty is an output uploaded without values as some inputs are missing
+lst_status_complete = ["done", "empty"]
+
+
+def name_to_key(name):
+    """convert a grib2 url or an output blob name to (analysis datetime string, forecast hour)"""
+    d, t, f = re.findall(rs_name, name)[0]
+    analysis_dttm = datetime.strptime(f"{d} {t}:00:00", "%Y%m%d %H:%M:%S")
+
+    return analysis_dttm.strftime(dttm_format), int(f)
+
+
+def name_to_keys(name):
+    """keys of all forecast hours in an output blob name, the combined output of a run has one key
+    per forecast hour of its range, any other name has the key of name_to_key"""
+    matched = re.findall(rs_name_run, name)
+    if not matched:
+        return [name_to_key(name)]
+    d, t, f_first, f_last = matched[0]
+    analysis_dttm = datetime.strptime(f"{d} {t}:00:00", "%Y%m%d %H:%M:%S")
+
+    return [(analysis_dttm.strftime(dttm_format), f) for f in range(int(f_first), int(f_last) + 1)]
+
+
+class manifest(object):
+    """status, output blob, size and sha256 of the output in output_format of every processed file"""
+    def __init__(self, path=manifest_path, output_format=output_format):
+        self.path = path
+        self.output_format = output_format
+        self._lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            # a manifest written before the output format was in the key is dropped,
+            # it is empty then and rebuilt by reconcile
+            lst_column = [row[1] for row in self.conn.execute("PRAGMA table_info(manifest)")]
+            if lst_column and "output_format" not in lst_column:
+                self.conn.execute("DROP TABLE manifest")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS manifest (
+                                     output_format TEXT NOT NULL,
+                                     analysis_dttm TEXT NOT NULL,
+                                     forecast_hour INTEGER NOT NULL,
+                                     status TEXT NOT NULL,
+                                     blob_name TEXT,
+                                     n_bytes INTEGER,
+                                     sha256 TEXT,
+                                     updated TEXT NOT NULL,
+                                     PRIMARY KEY (output_format, analysis_dttm, forecast_hour))""")
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM manifest WHERE output_format = ?",
+                                     (self.output_format,)).fetchone()[0]
+
+    def mark(self, analysis_dttm_str, forecast_hour, status, blob_name=None, n_bytes=None, sha256=None):
+        """insert or replace the row of one file in its own transaction"""
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (self.output_format, analysis_dttm_str, forecast_hour, status, blob_name, n_bytes, sha256,
+                               datetime.utcnow().strftime(dttm_format)))
+
+    def mark_grib2(self, grib2, status="done"):
+        """record the uploaded output of grib2data"""
+        self.mark(grib2.analysis_dttm_str, grib2.valid_hour, status, grib2.get_url_output_relative(),
+                  grib2.output_nbytes, grib2.output_sha256)
+
+    def get_status(self, analysis_dttm_str, forecast_hour):
+        """status of one file, None if it is not in the manifest"""
+        with self._lock:
+            row = self.conn.execute("SELECT status FROM manifest WHERE output_format = ? AND analysis_dttm = ? AND forecast_hour = ?",
+                                    (self.output_format, analysis_dttm_str, forecast_hour)).fetchone()
+
+        return row[0] if row else None
+
+    def get_missing(self, lst_url_grib2):
+        """the urls of lst_url_grib2 whose output is not complete, in the same order"""
+        with self._lock:
+            set_complete = set(self.conn.execute(
+                f"SELECT analysis_dttm, forecast_hour FROM manifest WHERE output_format = ? AND "
+                f"status IN ({','.join('?'*len(lst_status_complete))})",
+                [self.output_format] + lst_status_complete).fetchall())
+
+        return [url_grib2 for url_grib2 in lst_url_grib2 if name_to_key(url_grib2) not in set_complete]
+
+    def reconcile(self, container_client, folder, extension):
+        """rebuild the rows of output_format from a listing of its outputs in folder with extension,
+        all outputs listed are marked as done, with every forecast hour of a combined output"""
+        rows = []
+        updated = datetime.utcnow().strftime(dttm_format)
+        for blob in container_client.list_blobs(name_starts_with=f"{folder}/hrrr"):
+            if blob["name"].endswith(extension):
+                for (analysis_dttm_str, forecast_hour) in name_to_keys(blob["name"]):
+                    rows.append((self.output_format, analysis_dttm_str, forecast_hour, "done", blob["name"],
+                                 blob["size"], None, updated))
+
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM manifest WHERE output_format = ?", (self.output_format,))
+            self.conn.executemany("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        return len(rows)
+
+    def close(self):
+        self.conn.close()
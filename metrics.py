@@ -0,0 +1,93 @@
+"""timing spans and counters of the stages of grib2data: idx fetch, range fetch,
+decode, gather, assembly of the df, serialization and upload.
+every record is passed to a pluggable sink, e.g., a JSON lines file, and a summary
+with percentiles of every span is computed at the end of a run"""
+from utils import metrics_path
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+import json
+import time
+
+
+def percentile(lst_value, q):
+    """nearest-rank percentile q in [0, 100] of a sorted list"""
+    if not lst_value:
+        return None
+
+    return lst_value[min(len(lst_value) - 1, max(0, round(q/100*len(lst_value)) - 1))]
+
+
+class json_lines_sink(object):
+    """sink writing every record as one JSON line to path"""
+    def __init__(self, path):
+        self.f = open(path, "a", buffering=1)
+        self._lock = Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self.f.write(line + "\n")
+
+    def close(self):
+        self.f.close()
+
+
+class metrics(object):
+    """spans and counters of a run, sink is a callable taking a dict or None"""
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.dict_seconds = defaultdict(list)
+        self.dict_counter = defaultdict(float)
+        self._lock = Lock()
+
+    def emit(self, record):
+        if self.sink is not None:
+            self.sink({"time": time.time(), **record})
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """time the block, attributes can be added to the yielded dict inside the block"""
+        t = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            seconds = time.perf_counter() - t
+            with self._lock:
+                self.dict_seconds[name].append(seconds)
+            self.emit({"type": "span", "name": name, "seconds": seconds, **attrs})
+
+    def count(self, name, value=1, **attrs):
+        with self._lock:
+            self.dict_counter[name] += value
+        self.emit({"type": "counter", "name": name, "value": value, **attrs})
+
+    def summary(self):
+        """count, total, p50, p90, p99 and max seconds of every span and the totals of the counters"""
+        with self._lock:
+            dict_seconds = {name: sorted(lst_seconds) for (name, lst_seconds) in self.dict_seconds.items()}
+            dict_counter = dict(self.dict_counter)
+        spans = {name: {"n": len(lst_seconds),
+                        "total": sum(lst_seconds),
+                        "p50": percentile(lst_seconds, 50),
+                        "p90": percentile(lst_seconds, 90),
+                        "p99": percentile(lst_seconds, 99),
+                        "max": lst_seconds[-1]}
+                 for (name, lst_seconds) in dict_seconds.items()}
+
+        return {"spans": spans, "counters": dict_counter}
+
+    def emit_summary(self):
+        summary = self.summary()
+        self.emit({"type": "summary", **summary})
+
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self.dict_seconds.clear()
+            self.dict_counter.clear()
+
+
+# shared by all grib2data objects of this process
+recorder = metrics(json_lines_sink(metrics_path) if metrics_path else None)
@@ -0,0 +1,105 @@
+"""source selection between mirrors of the HRRR grib2 files, i.e., the public noaahrrr container,
+our hrrrdata copy and the Google Cloud bucket, which hold byte-identical files so the byte ranges
+of one idx are valid on all of them. the latencies of the range requests are tracked per mirror,
+the fastest mirror is asked first, and a duplicate (hedged) request is sent to the next mirror when
+the first one takes longer than the hedge_percentile of its latencies. the first response wins"""
+from utils import mirror_roots, hedge_percentile, hedge_delay_default, hedge_min_samples, hedge_latency_window, http_pool_size
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from threading import Lock
+from metrics import recorder, percentile
+import transport
+import time
+
+
+class mirror_set(object):
+    """mirrors of the grib2 files, lst_root are the urls under which the paths hrrr.<date>/conus/... are the same"""
+    def __init__(self, lst_root, q=hedge_percentile, delay_default=hedge_delay_default,
+                 min_samples=hedge_min_samples, window=hedge_latency_window):
+        self.lst_root = [root.rstrip("/") for root in lst_root]
+        self.q = q
+        self.delay_default = delay_default
+        self.min_samples = min_samples
+        self.dict_latency = {root: deque(maxlen=window) for root in self.lst_root}
+        self._lock = Lock()
+        # a hedged request and the request it duplicates run in this pool, the loser is not cancelled
+        self.executor = ThreadPoolExecutor(2*http_pool_size)
+
+    def split_url(self, url):
+        """(root, relative path) of url, root None if url is not on a mirror"""
+        for root in self.lst_root:
+            if url.startswith(f"{root}/"):
+                return root, url[len(root):]
+
+        return None, url
+
+    def rank(self):
+        """mirrors from the fastest to the slowest by median latency, a mirror without latencies yet comes first"""
+        with self._lock:
+            dict_p50 = {root: percentile(sorted(lst_latency), 50) or 0.0
+                        for (root, lst_latency) in self.dict_latency.items()}
+
+        return sorted(self.lst_root, key=lambda root: dict_p50[root])
+
+    def get_delay(self, root):
+        """seconds to wait for root before hedging"""
+        with self._lock:
+            lst_latency = sorted(self.dict_latency[root])
+        if len(lst_latency) < self.min_samples:
+            return self.delay_default
+
+        return percentile(lst_latency, self.q)
+
+    def get_one(self, root, relative, range_start, range_end):
+        """range request to one mirror, its latency is recorded if it is answered,
+        and the time until the last retry failed if it is not, so a failing mirror ranks last"""
+        t = time.perf_counter()
+        try:
+            resp = transport.get(f"{root}{relative}", range_start, range_end)
+        except Exception:
+            with self._lock:
+                self.dict_latency[root].append(time.perf_counter() - t)
+            raise
+        if resp.status_code in (200, 206):
+            with self._lock:
+                self.dict_latency[root].append(time.perf_counter() - t)
+
+        return resp
+
+    def get(self, url, range_start=None, range_end=None):
+        """the same as transport.get, but from the two fastest mirrors of url with hedging.
+        a mirror that does not have the file, or fails, leaves the answer to the other one"""
+        root, relative = self.split_url(url)
+        if root is None or len(self.lst_root) < 2:
+            return transport.get(url, range_start, range_end)
+
+        root_first, root_second = self.rank()[:2]
+        future_first = self.executor.submit(self.get_one, root_first, relative, range_start, range_end)
+        done, _ = wait([future_first], timeout=self.get_delay(root_first))
+        if done and future_first.exception() is None and future_first.result().status_code in (200, 206):
+            return future_first.result()
+
+        recorder.count("hedged", url=url, mirror=root_second)
+        future_second = self.executor.submit(self.get_one, root_second, relative, range_start, range_end)
+        pending = {future_first, future_second}
+        resp, error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                elif future.result().status_code in (200, 206):
+                    if future is future_second:
+                        recorder.count("hedge_won", mirror=root_second)
+                    return future.result()
+                else:
+                    # 404 or another status of the caller, kept if no mirror has the range
+                    resp = future.result()
+        if resp is not None:
+            return resp
+
+        raise error
+
+
+# shared by all grib2data objects of this process, None if there is only one source
+source_mirrors = mirror_set(mirror_roots) if len(mirror_roots) > 1 else None
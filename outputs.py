@@ -0,0 +1,21 @@
+"""outputs of a processed grib2 file: its blob in the target container, its rows in the time series store
+and its record in the manifest. the pipelines of process_grib2_az and the runs of grib2run all write them
+with upload_grib2, so an output is the same whichever way its file was processed"""
+from metrics import recorder
+from timeseries_store import store_timeseries
+
+
+def write_timeseries(grib2):
+    """write the df of grib2data to the time series store, if it is enabled"""
+    if store_timeseries is not None:
+        with recorder.span("timeseries_write", url=grib2.url_grib2):
+            store_timeseries.write(grib2)
+
+
+def upload_grib2(grib2, container_client, manifest_outputs=None, status="done"):
+    """upload the output of grib2data, write it to the time series store and mark it in the manifest"""
+    # serialized and uploaded from memory, nothing is written to /tmp
+    grib2.upload_blob(container_client)
+    write_timeseries(grib2)
+    if manifest_outputs is not None:
+        manifest_outputs.mark_grib2(grib2, status)
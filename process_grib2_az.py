@@ -1,18 +1,22 @@
 from azure.storage.blob import BlobServiceClient
 from azureml.core import Workspace, Dataset
-from grib2data import grib2data
-from multiprocessing import Pool
+from grib2data import grib2data, dict_output_format, get_url_grid_def
+from field_cache import cache_fields
+from byte_cache import cache_bytes
+from metrics import recorder
+from timeseries_store import store_timeseries
+from outputs import upload_grib2
+import json
+import transport
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import partial
-import pandas as pd
-import re
-from datetime import datetime
-
-def name_to_timestamp(x):
-    """convert url to timestamp, it works for both grib2 and csv urls"""
-    regex = r".*hrrr.(\d{8}).*hrrr.t(\d{2})z.*"
-    d, t = re.findall(regex, x)[0]
-    
-    return datetime.strptime(f"{d} {t}:00:00", "%Y%m%d %H:%M:%S")
+from shared_pool import shared_slots, init_worker, decode_to_slot
+import asyncio
+import os
+from utils import output_format, output_columns, grid_index_path
+from grid_index import load_grid_index
+from manifest import manifest
+from lease import iter_claimed_batches
 
 
 # environment variables
@@ -22,16 +26,137 @@ workspace_name = ''
 connect_str = ""
 container_name = ""
 
+# concurrency of the pipeline: files being downloaded, decoded and uploaded at the same time,
+# and the max number of files held in memory between the stages
+n_fetch = 16
+n_decode = os.cpu_count()
+n_upload = 4
+max_in_flight = 32
+# decode in processes instead of threads
+decode_in_processes = False
+# rebuild the manifest from a listing of the container before processing
+reconcile = False
+# share the missing files with the workers on other nodes, see lease.py
+use_leases = False
+# download and decode in n_decode processes with the grid and the outputs in shared memory, see shared_pool
+use_shared_memory = False
+
+
+def fetch_grib2(url_grib2, lst_unique_grid, **kwargs):
+    """construct grib2data and download its messages, kwargs are passed to grib2data
+    output: grib2data and False if some of its inputs are missing"""
+    grib2 = grib2data(url_grib2, lst_unique_grid, **kwargs)
+    try:
+        grib2.fetch()
+    except TypeError:
+        return grib2, False
+
+    return grib2, True
+
 
-def process_grib2_az(url_grib2, lst_unique_grid, container_client):
-    grib2 = grib2data(url_grib2, lst_unique_grid)
+def decode_grib2(grib2):
+    """decode the downloaded messages of grib2data into its df
+    output: grib2data and False if some of its inputs are missing"""
     try:
         grib2.get_vars()
-    except (TypeError, SystemExit):
-        pass
-    grib2.write_to_disk()
-    grib2.upload_blob(container_client)
-    grib2.remove_from_disk()
+    except TypeError:
+        return grib2, False
+
+    return grib2, True
+
+
+def process_grib2_az(url_grib2, lst_unique_grid, container_client, manifest_outputs=None):
+    grib2, fetched = fetch_grib2(url_grib2, lst_unique_grid)
+    if fetched:
+        grib2, fetched = decode_grib2(grib2)
+    upload_grib2(grib2, container_client, manifest_outputs, "done" if fetched else "empty")
+
+
+async def process_grib2_az_async(lst_url_grib2, lst_unique_grid, container_client, manifest_outputs=None, **kwargs):
+    """process many grib2 files with a pipeline of three stages: download, decode and upload.
+    each stage runs in its own pool so downloads of the next files overlap with the decoding
+    and the upload of the previous ones, and at most max_in_flight files are in memory.
+    a file whose download fails after all retries is not uploaded. kwargs are passed to grib2data.
+    output: number of files which failed"""
+    # every download thread gets a keep-alive connection
+    transport.configure(max(n_fetch, transport.http_pool_size))
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(max_in_flight)
+    executor_decode = ProcessPoolExecutor(n_decode) if decode_in_processes else ThreadPoolExecutor(n_decode)
+    n_done = 0
+    n_failed = 0
+
+    async def process_one(url_grib2):
+        nonlocal n_done, n_failed
+        async with in_flight:
+            try:
+                grib2, fetched = await loop.run_in_executor(executor_fetch, partial(fetch_grib2, **kwargs),
+                                                            url_grib2, lst_unique_grid)
+                if fetched:
+                    grib2, fetched = await loop.run_in_executor(executor_decode, decode_grib2, grib2)
+                await loop.run_in_executor(executor_upload, upload_grib2, grib2, container_client,
+                                           manifest_outputs, "done" if fetched else "empty")
+            except Exception as e:
+                print("failed", url_grib2, repr(e), flush=True)
+                n_failed += 1
+                return
+            print(n_done, url_grib2, flush=True)
+            n_done += 1
+
+    with ThreadPoolExecutor(n_fetch) as executor_fetch, executor_decode, \
+            ThreadPoolExecutor(n_upload) as executor_upload:
+        await asyncio.gather(*[process_one(url_grib2) for url_grib2 in lst_url_grib2])
+
+    return n_failed
+
+
+async def process_grib2_az_shared_async(lst_url_grib2, lst_unique_grid, container_client, manifest_outputs=None):
+    """the same as process_grib2_az_async, but every file is downloaded and decoded in a worker process
+    which writes its columns to a slot in shared memory, the df is assembled and uploaded by this process.
+    there are max_in_flight slots, a file waits for a free slot before it is sent to a worker.
+    output: number of files which failed"""
+    loop = asyncio.get_running_loop()
+    slots = shared_slots(lst_unique_grid, max_in_flight, output_columns)
+    slots_free = asyncio.Queue()
+    for slot in range(max_in_flight):
+        slots_free.put_nowait(slot)
+    n_done = 0
+    n_failed = 0
+
+    async def process_one(url_grib2):
+        nonlocal n_done, n_failed
+        slot = await slots_free.get()
+        try:
+            fetched = await loop.run_in_executor(executor_decode, decode_to_slot, url_grib2, slot)
+            # nothing is downloaded here, the idx of grib2data is fetched on first use only
+            grib2 = grib2data(url_grib2, lst_unique_grid, columns=slots.columns)
+            if fetched:
+                grib2.assemble(slots.get_values(slot))
+        except Exception as e:
+            print("failed", url_grib2, repr(e), flush=True)
+            n_failed += 1
+            return
+        finally:
+            slots_free.put_nowait(slot)
+        try:
+            await loop.run_in_executor(executor_upload, upload_grib2, grib2, container_client,
+                                       manifest_outputs, "done" if fetched else "empty")
+        except Exception as e:
+            print("failed", url_grib2, repr(e), flush=True)
+            n_failed += 1
+            return
+        print(n_done, url_grib2, flush=True)
+        n_done += 1
+
+    try:
+        with ProcessPoolExecutor(n_decode, initializer=init_worker,
+                                 initargs=(slots.desc_grid, slots.desc_slots, slots.columns)) as executor_decode, \
+                ThreadPoolExecutor(n_upload) as executor_upload:
+            await asyncio.gather(*[process_one(url_grib2) for url_grib2 in lst_url_grib2])
+    finally:
+        slots.close()
+
+    return n_failed
 
 
 if __name__ == "__main__":
@@ -48,33 +173,39 @@ if __name__ == "__main__":
                                 to_pandas_dataframe()["Column1"].\
                                 tolist()
 
-    # grid points with assets
-    lst_unique_grid = Dataset.get_by_name(workspace, name="unique_grid_id").to_pandas_dataframe()["hrrr_id"].tolist()
-    
-    # find out which CSV files are missing, i.e., a list of files to process
-    # list csv files
-    blob_iter = container_client.list_blobs(name_starts_with="CSV/hrrr")
-    blob_list = []
-    for blob in blob_iter:
-        blob_list.append(blob["name"])
-    blob_list_csv = list(filter(lambda x: x.endswith(".csv"), blob_list))
-
-    # availabe grib2 in df
-    df_grib2 = pd.DataFrame({"dttm_grib2":list(map(name_to_timestamp, blob_list_grib2_f00_full))})
-
-    # availabe csv in a df
-    df_csv = pd.DataFrame({"dttm_csv":list(map(name_to_timestamp, blob_list_csv))})
-
-    df_merge = pd.merge(df_grib2, df_csv, left_on="dttm_grib2", right_on="dttm_csv", how="left")
-    indices_2b_processed = df_merge.loc[df_merge.dttm_csv.isnull()].index.tolist()
-    url_2b_processed = [blob_list_grib2_f00_full[i] for i in indices_2b_processed]
-
-    # serial execution
-    for (i, url_grib2) in enumerate(url_2b_processed):
-        process_grib2_az(url_grib2, lst_unique_grid, container_client)
-        print(i, url_grib2, flush=True)
-
-    # using thread pool
-    # with Pool(processes=2) as pool:
-    #     pool.map(partial(process_grib2_az, lst_unique_grid=lst_unique_grid), 
-    #             url_2b_processed)
+    # find out which output files are missing, i.e., a list of files to process.
+    # the manifest is updated as every file is uploaded, the container is
+    # only listed to build it for the first time or when asked to reconcile
+    manifest_outputs = manifest(output_format=output_format)
+    if reconcile or len(manifest_outputs) == 0:
+        folder_output, extension_output = dict_output_format[output_format]
+        manifest_outputs.reconcile(container_client, folder_output, extension_output)
+    url_2b_processed = manifest_outputs.get_missing(blob_list_grib2_f00_full)
+
+    # grid points with assets, memory-mapped from the grid index built by gen_grid_id.py if there is one.
+    # the index is checked against the grid definition of the first file to process before anything is gathered
+    if grid_index_path:
+        lst_unique_grid = load_grid_index(grid_index_path, get_url_grid_def(url_2b_processed))["indices"]
+    else:
+        lst_unique_grid = Dataset.get_by_name(workspace, name="unique_grid_id").to_pandas_dataframe()["hrrr_id"].tolist()
+
+    # pipelined execution, process_grib2_az processes one file at a time
+    process_async = process_grib2_az_shared_async if use_shared_memory else process_grib2_az_async
+    if use_leases:
+        # every worker runs the same list, a batch is processed by the worker holding its lease only.
+        # a batch with failed files is released without its files marked completed so another worker retries it
+        for lease, lst_url_batch in iter_claimed_batches(container_client, url_2b_processed):
+            try:
+                if asyncio.run(process_async(lst_url_batch, lst_unique_grid, container_client, manifest_outputs)) == 0:
+                    lease.complete(lst_url_batch)
+            finally:
+                lease.release()
+    else:
+        asyncio.run(process_async(url_2b_processed, lst_unique_grid, container_client, manifest_outputs))
+    # the time chunks of the time series store not complete yet are written now
+    if store_timeseries is not None:
+        store_timeseries.flush()
+    print(cache_fields.stats(), flush=True)
+    if cache_bytes is not None:
+        print(cache_bytes.stats(), flush=True)
+    print(json.dumps(recorder.emit_summary(), indent=1), flush=True)
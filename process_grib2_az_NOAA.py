@@ -1,6 +1,11 @@
 from process_grib2_az import *
+from backfill_planner import backfill_plan
+from datetime import datetime
 
-url_NOAAHRRR = "https://noaahrrr.blob.core.windows.net/hrrr/hrrr.INPUT_DATE/conus/hrrr.tINPUT_HOURz.wrfsfcf00.grib2"
+# analysis hours [dttm_start, dttm_end) and forecast hours to backfill from the public noaahrrr container
+dttm_start = datetime(2021, 11, 7)
+dttm_end = datetime(2021, 12, 1)
+hours_forecast = [0]
 
 if __name__ == "__main__":
     workspace = Workspace(subscription_id, resource_group, workspace_name)
@@ -11,9 +16,17 @@ if __name__ == "__main__":
 
     lst_unique_grid = Dataset.get_by_name(workspace, name="unique_grid_id").to_pandas_dataframe()["hrrr_id"].tolist()
 
-    dttms = pd.date_range("2021-11-07", "2021-12-01", freq="h", closed="left")
-    for input_dttm in dttms:
-        input_d = input_dttm.strftime("%Y%m%d")
-        input_h = input_dttm.strftime("%H")
-        url_grib2 = url_NOAAHRRR.replace("INPUT_DATE", input_d).replace("INPUT_HOUR", input_h)
-        process_grib2_az(url_grib2, lst_unique_grid, container_client)
+    # outputs to process and their cost, the outputs complete in the manifest are skipped
+    # and those whose inputs are missing are reported and not processed
+    manifest_outputs = manifest()
+    plan = backfill_plan(dttm_start, dttm_end, hours_forecast, lst_unique_grid, manifest_outputs)
+    plan.print_summary()
+
+    # a run whose download fails after all retries is reported, its forecast hours not uploaded yet are not.
+    # the files of the runs which are not chained, all of them with hours_forecast [0], go through the pipeline
+    plan.run(container_client, manifest_outputs, process_async=process_grib2_az_async)
+    # the time chunks of the time series store not complete yet are written now
+    if store_timeseries is not None:
+        store_timeseries.flush()
+    print(cache_fields.stats(), flush=True)
+    print(json.dumps(recorder.emit_summary(), indent=1), flush=True)
@@ -0,0 +1,78 @@
+"""shared memory of the process pool mode of process_grib2_az.
+the grid points and one output slot per file in flight live in multiprocessing.shared_memory:
+arr_grid: intp (n_points,), lst_unique_grid, written once by the parent
+arr_slots: float32 (n_slots, n_columns, n_points), a worker writes the decoded columns of a file to its slot
+a worker attaches to both when it starts, and a task is only the url of a file and a slot number,
+so neither the grid nor the decoded values are pickled between the processes"""
+from grib2data import grib2data, dict_column_var
+from multiprocessing import shared_memory
+from numpy import asarray, dtype, float32, intp, ndarray, prod
+import transport
+
+# views of the shared memory in a worker, set by init_worker
+dict_worker = {}
+
+
+def create_shared_array(shape, dtype_array):
+    """new shared memory block with an array view of it
+    output: SharedMemory, ndarray and the descriptor (name, shape, dtype) to attach to it"""
+    dtype_array = dtype(dtype_array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(prod(shape))*dtype_array.itemsize))
+    arr = ndarray(shape, dtype=dtype_array, buffer=shm.buf)
+
+    return shm, arr, (shm.name, tuple(shape), dtype_array.str)
+
+
+def attach_shared_array(desc):
+    """SharedMemory and array view of the block of the descriptor from create_shared_array"""
+    name, shape, dtype_array = desc
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, ndarray(shape, dtype=dtype(dtype_array), buffer=shm.buf)
+
+
+class shared_slots(object):
+    """grid points and output slots in shared memory, owned by the parent process"""
+    def __init__(self, lst_unique_grid, n_slots, columns=None):
+        self.columns = list(columns or dict_column_var)
+        arr_unique_grid = asarray(lst_unique_grid, dtype=intp)
+        self.shm_grid, self.arr_grid, self.desc_grid = create_shared_array(arr_unique_grid.shape, intp)
+        self.arr_grid[:] = arr_unique_grid
+        self.shm_slots, self.arr_slots, self.desc_slots = \
+            create_shared_array((n_slots, len(self.columns), len(arr_unique_grid)), float32)
+
+    def get_values(self, slot):
+        """copy of the columns written to slot, the slot can be reused afterwards"""
+        return {column: self.arr_slots[slot, k].copy() for (k, column) in enumerate(self.columns)}
+
+    def close(self):
+        # the views must be released before the blocks are closed
+        del self.arr_grid, self.arr_slots
+        for shm in (self.shm_grid, self.shm_slots):
+            shm.close()
+            shm.unlink()
+
+
+def init_worker(desc_grid, desc_slots, columns):
+    """initializer of the worker processes: attach to the shared memory and open a new HTTP session,
+    the connections of the parent are not shared"""
+    transport.configure()
+    dict_worker["shm_grid"], dict_worker["arr_grid"] = attach_shared_array(desc_grid)
+    dict_worker["shm_slots"], dict_worker["arr_slots"] = attach_shared_array(desc_slots)
+    dict_worker["columns"] = columns
+
+
+def decode_to_slot(url_grib2, slot):
+    """download and decode one grib2 file in a worker, its columns are written to slot
+    output: False if some of its inputs are missing and nothing is written"""
+    grib2 = grib2data(url_grib2, dict_worker["arr_grid"], columns=dict_worker["columns"])
+    try:
+        dict_values = grib2.get_values()
+    except TypeError:
+        return False
+
+    arr_slot = dict_worker["arr_slots"][slot]
+    for (k, column) in enumerate(dict_worker["columns"]):
+        arr_slot[k] = dict_values[column]
+
+    return True
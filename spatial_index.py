@@ -0,0 +1,73 @@
+"""nearest grid point lookup of arbitrary lat/lon sets on the HRRR grid.
+the grid points are placed on the unit sphere and indexed with a KD-tree,
+so one vectorized query maps millions of asset coordinates to hrrr_id"""
+from grid_index import load_grid_index
+from scipy.spatial import cKDTree
+from numpy import arcsin, asarray, cos, deg2rad, float64, int32, ones_like, searchsorted, sin, stack, unique, where
+import pandas as pd
+
+radius_earth_km = 6371.0
+
+
+def latlon_to_xyz(lat, lon):
+    """lat, lon in degrees to points on the unit sphere"""
+    lat, lon = deg2rad(asarray(lat, dtype=float64)), deg2rad(asarray(lon, dtype=float64))
+
+    return stack([cos(lat)*cos(lon), cos(lat)*sin(lon), sin(lat)], axis=-1)
+
+
+class grid_tree(object):
+    """KD-tree of the points of a (y, x) lat/lon grid, a point is identified by its flat index, i.e., hrrr_id"""
+    def __init__(self, lat, lon):
+        self.shape = asarray(lat).shape
+        self.tree = cKDTree(latlon_to_xyz(asarray(lat).ravel(), asarray(lon).ravel()))
+
+    @classmethod
+    def from_grid_index(cls, path):
+        """KD-tree of the grid of a grid index built by gen_grid_id.py"""
+        grid = load_grid_index(path)
+
+        return cls(grid["lat"], grid["lon"])
+
+    def query(self, lat, lon, k=1):
+        """the k nearest grid points of every lat, lon
+        output: flat indices and distances in km, of shape (n,) for k=1 and (n, k) otherwise"""
+        chord, indices = self.tree.query(latlon_to_xyz(lat, lon), k=k)
+        distances = 2*radius_earth_km*arcsin(chord/2)
+
+        return indices.astype(int32), distances
+
+    def query_idw(self, lat, lon, k=4, power=2):
+        """the k nearest grid points of every lat, lon with inverse distance weights
+        output: flat indices and weights, both of shape (n, k), the weights of a row sum to 1"""
+        indices, distances = self.query(lat, lon, k=k)
+        if k == 1:
+            return indices[:, None], ones_like(distances)[:, None]
+
+        # a point on a grid point takes its value only
+        on_grid = (distances == 0).any(axis=1, keepdims=True)
+        weights = where(on_grid, (distances == 0)*1.0, 1/where(distances == 0, 1, distances)**power)
+        weights = weights/weights.sum(axis=1, keepdims=True)
+
+        return indices, weights
+
+
+def assets_to_grid(df_assets, tree, k=1, power=2, lat_col="lat", lon_col="lon"):
+    """map assets to the grid points to extract
+    input: df_assets / DataFrame with the coordinates of the assets in lat_col and lon_col,
+    tree / grid_tree, k / number of grid points per asset, power / of the inverse distance weights
+    output: lst_unique_grid / sorted int32 array of the grid points to pass to grib2data,
+    positions / (n, k) positions in lst_unique_grid of the grid points of every asset,
+    weights / (n, k) weights of these grid points"""
+    indices, weights = tree.query_idw(df_assets[lat_col].values, df_assets[lon_col].values, k=k, power=power)
+    lst_unique_grid = unique(indices).astype(int32)
+    positions = searchsorted(lst_unique_grid, indices)
+
+    return lst_unique_grid, positions, weights
+
+
+def interpolate_df(df_grib2, positions, weights, columns):
+    """values of the assets from the df of grib2data, which has one row per grid point of lst_unique_grid
+    input: positions, weights / from assets_to_grid, columns / columns of df_grib2 to interpolate
+    output: DataFrame with one row per asset"""
+    return pd.DataFrame({column: (df_grib2[column].values[positions]*weights).sum(axis=1) for column in columns})
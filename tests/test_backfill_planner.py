@@ -0,0 +1,115 @@
+"""chaining of the runs of a backfill_plan and its failure paths, nothing is downloaded"""
+import pytest
+
+for module in ["eccodes", "numpy", "pandas", "requests", "dateutil", "zarr"]:
+    pytest.importorskip(module)
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import backfill_planner
+import grib2run
+from backfill_planner import backfill_plan, url_root_NOAAHRRR
+from grib2data import timestamp_to_url
+
+dttm_start = datetime(2021, 1, 1, 0)
+
+
+def make_plan(monkeypatch, n_hours, hours_forecast, lst_skip=(), **kwargs):
+    """backfill_plan of n_hours analysis hours with all inputs present, but the outputs in lst_skip,
+    (analysis hour, forecast hour), which are missing"""
+    def fake_make_grib2data(lst_url_grib2, lst_unique_grid, on_ready=None, **kwargs):
+        for url_grib2 in lst_url_grib2:
+            analysis_dttm, valid_hour = dict_url[url_grib2]
+            if (analysis_dttm.hour, valid_hour) not in lst_skip:
+                on_ready(SimpleNamespace(url_grib2=url_grib2, analysis_dttm=analysis_dttm, valid_hour=valid_hour), {})
+        return [], {"missing": {}, "failed": {}, "incomplete": {}}
+
+    dict_url = {timestamp_to_url(dttm_start + timedelta(hours=i), f"{h:02}", url_root_NOAAHRRR):
+                (dttm_start + timedelta(hours=i), h) for i in range(n_hours) for h in hours_forecast}
+    monkeypatch.setattr(backfill_planner, "make_grib2data", fake_make_grib2data)
+
+    return backfill_plan(dttm_start, dttm_start + timedelta(hours=n_hours), hours_forecast, [3, 1, 2], **kwargs)
+
+
+@pytest.fixture
+def runs_log(monkeypatch):
+    """replace the processing of a run: f00 takes the values of the previous run, f01 gives its own,
+    a run of an analysis hour in runs_log["fail"] fails before its f01"""
+    log = {"received": {}, "fail": set(), "processed": []}
+
+    def fake_process_hours(self, container_client, manifest_outputs=None):
+        if self.future_values_b is not None:
+            log["received"][self.analysis_dttm.hour] = self.future_values_b.result(timeout=10)
+        if self.analysis_dttm.hour in log["fail"]:
+            raise RuntimeError("download failed")
+        if self.future_values_f01 is not None:
+            self.future_values_f01.set_result({"from": self.analysis_dttm.hour})
+        self.dict_status = {hour_forecast: "done" for hour_forecast in self.hours_forecast}
+        log["processed"].append(self.analysis_dttm.hour)
+
+    monkeypatch.setattr(grib2run.grib2run, "process_hours", fake_process_hours)
+
+    return log
+
+
+def test_runs_are_chained_when_f01_is_planned(monkeypatch):
+    plan = make_plan(monkeypatch, 4, [0, 1, 2], lst_skip=[(1, 1)])
+    lst_run = plan.get_runs()
+
+    assert [run.hours_forecast for run in lst_run] == [[0, 1, 2], [0, 2], [0, 1, 2], [0, 1, 2]]
+    # the run of 01z has no f01, so the run of 02z is not chained to it
+    assert lst_run[0].future_values_f01 is lst_run[1].future_values_b is not None
+    assert lst_run[1].future_values_f01 is None and lst_run[2].future_values_b is None
+    assert lst_run[2].future_values_f01 is lst_run[3].future_values_b is not None
+    assert all(run.lst_unique_grid is plan.arr_unique_grid for run in lst_run)
+
+
+def test_runs_take_the_settings_of_the_plan(monkeypatch):
+    plan = make_plan(monkeypatch, 2, [0, 1], gap_max=1234, columns=["temperature"], output_format="parquet")
+
+    for run in plan.get_runs():
+        assert (run.gap_max, run.columns, run.output_format) == (1234, ["temperature"], "parquet")
+        assert run.grid_key == plan.grid_key
+
+
+def test_f01_values_are_handed_to_the_next_f00(monkeypatch, runs_log):
+    plan = make_plan(monkeypatch, 4, [0, 1])
+
+    assert plan.run(None, n_runs=4) == 0
+    assert runs_log["received"] == {1: {"from": 0}, 2: {"from": 1}, 3: {"from": 2}}
+
+
+def test_failed_run_does_not_block_the_next_one(monkeypatch, runs_log):
+    plan = make_plan(monkeypatch, 3, [0, 1])
+    runs_log["fail"].add(1)
+
+    assert plan.run(None, n_runs=1) == 1
+    # the run of 02z takes no values and processes its f00 with those of its own _b file
+    assert runs_log["received"] == {1: {"from": 0}, 2: {}}
+    assert runs_log["processed"] == [0, 2]
+
+
+def test_single_runs_go_through_the_pipeline(monkeypatch, runs_log):
+    plan = make_plan(monkeypatch, 3, [0], gap_max=1234)
+    calls = []
+
+    async def fake_process_async(lst_url_grib2, lst_unique_grid, container_client, manifest_outputs=None, **kwargs):
+        calls.append((lst_url_grib2, lst_unique_grid, kwargs))
+        return 1
+
+    assert plan.run(None, process_async=fake_process_async) == 1
+    assert runs_log["processed"] == []
+    ((lst_url_grib2, lst_unique_grid, kwargs),) = calls
+    assert lst_url_grib2 == plan.lst_url_grib2
+    assert lst_unique_grid is plan.arr_unique_grid
+    assert kwargs == {"grid_key": plan.grid_key, "gap_max": 1234}
+
+
+def test_chained_runs_are_not_sent_to_the_pipeline(monkeypatch, runs_log):
+    plan = make_plan(monkeypatch, 2, [0, 1])
+
+    async def fake_process_async(lst_url_grib2, *args, **kwargs):
+        raise AssertionError(lst_url_grib2)
+
+    assert plan.run(None, process_async=fake_process_async) == 0
+    assert sorted(runs_log["processed"]) == [0, 1]
@@ -0,0 +1,36 @@
+"""merging of the byte ranges of the messages of a grib2 file, nothing is downloaded"""
+import pytest
+
+for module in ["eccodes", "numpy", "pandas", "requests", "dateutil"]:
+    pytest.importorskip(module)
+
+from collections import OrderedDict
+from grib2data import plan_byte_ranges
+
+# messages of 100 bytes at 0, 100, 200, ..., 900, the last one to the end of the file
+dict_var_br = OrderedDict((var_num, (f"{100*(var_num - 1)}-{100*var_num - 1}" if var_num < 10 else "900-", ""))
+                          for var_num in range(1, 11))
+
+
+def test_adjacent_messages_are_merged():
+    assert plan_byte_ranges([2, 3, 4], dict_var_br, gap_max=0) == [(100, 399, [2, 3, 4])]
+
+
+def test_messages_are_merged_over_a_small_gap_only():
+    # 100 bytes between 2 and 4, 300 between 4 and 8
+    assert plan_byte_ranges([2, 4, 8], dict_var_br, gap_max=100) == [(100, 399, [2, 4]), (700, 799, [8])]
+    assert plan_byte_ranges([2, 4, 8], dict_var_br, gap_max=99) == [(100, 199, [2]), (300, 399, [4]), (700, 799, [8])]
+
+
+def test_order_and_duplicates_of_var_nums():
+    assert plan_byte_ranges([4, 2, 3, 2], dict_var_br, gap_max=0) == [(100, 399, [2, 3, 4])]
+
+
+def test_last_message_ends_with_the_file():
+    assert plan_byte_ranges([9, 10], dict_var_br, gap_max=0) == [(800, None, [9, 10])]
+    # nothing is merged after a range to the end of the file
+    assert plan_byte_ranges([1, 10], dict_var_br, gap_max=10**6) == [(0, None, [1, 10])]
+
+
+def test_no_messages():
+    assert plan_byte_ranges([], dict_var_br) == []
@@ -0,0 +1,45 @@
+"""look up of the variables of an idx file by name"""
+import pytest
+
+for module in ["numpy", "requests", "dateutil"]:
+    pytest.importorskip(module)
+
+from idx_store import get_var_br, get_var_name, find_var_num
+from utils import dict_var_name
+
+idx = ["1:0:d=2021010100:REFC:entire atmosphere:2 hour fcst:",
+       "2:100:d=2021010100:TMP:2 m above ground:2 hour fcst:",
+       "3:250:d=2021010100:APCP:surface:0-2 hour acc fcst:",
+       "4:300:d=2021010100:APCP:surface:1-2 hour acc fcst:",
+       "5:380:d=2021010100:CAPE:255-0 mb above ground:2 hour fcst:",
+       "6:420:d=2021010100:TMP:2 m above ground:2 hour fcst:"]
+
+
+def test_var_br():
+    dict_var_br = get_var_br(idx)
+    assert dict_var_br[2] == ("100-250", "TMP: 2 m above ground")
+    assert dict_var_br[6] == ("420-", "TMP: 2 m above ground")
+
+
+def test_find_var_num_by_time_range():
+    d = get_var_name(idx)
+    assert find_var_num(d, dict_var_name["precipitation_tot"], 2) == 3
+    assert find_var_num(d, dict_var_name["precipitation_tot_past_h"], 2) == 4
+    assert find_var_num(d, dict_var_name["CAPE255_h02plus"], 2) == 5
+
+
+def test_find_var_num_takes_the_first_of_duplicates():
+    assert find_var_num(get_var_name(idx), dict_var_name["temperature_2m"], 2) == 2
+
+
+def test_find_var_num_not_found():
+    d = get_var_name(idx)
+    # another forecast hour
+    assert find_var_num(d, dict_var_name["temperature_2m"], 3) == 0
+    assert find_var_num(d, dict_var_name["precipitation_tot"], 3) == 0
+    assert find_var_num(d, dict_var_name["wind_gust"], 2) == 0
+
+
+def test_find_var_num_analysis():
+    d = get_var_name(["1:0:d=2021010100:TMP:2 m above ground:anl:"])
+    assert find_var_num(d, dict_var_name["temperature_2m"], 0) == 1
@@ -0,0 +1,25 @@
+"""keys of the manifest from grib2 urls and output blob names"""
+import pytest
+
+for module in ["numpy", "dateutil"]:
+    pytest.importorskip(module)
+
+from manifest import name_to_key, name_to_keys
+
+
+def test_grib2_url_and_output_name_have_the_same_key():
+    url_grib2 = "https://noaahrrr.blob.core.windows.net/hrrr/hrrr.20210101/conus/hrrr.t06z.wrfsfcf02.grib2"
+    assert name_to_key(url_grib2) == ("2021-01-01 06:00:00", 2)
+    assert name_to_keys("CSV/hrrr.20210101/conus/hrrr.t06z.f02.csv") == [("2021-01-01 06:00:00", 2)]
+    assert name_to_keys("PARQUET/hrrr.20210101/conus/hrrr.t06z.f02.parquet") == [("2021-01-01 06:00:00", 2)]
+
+
+def test_combined_output_has_a_key_per_forecast_hour():
+    assert name_to_keys("CSV/hrrr.20190101/conus/hrrr.t23z.f00-f03.csv") == \
+        [("2019-01-01 23:00:00", hour_forecast) for hour_forecast in range(4)]
+    assert name_to_keys("CSV/hrrr.20190101/conus/hrrr.t00z.f05-f05.csv") == [("2019-01-01 00:00:00", 5)]
+
+
+def test_other_names_are_refused():
+    with pytest.raises(IndexError):
+        name_to_keys("CSV/readme.txt")
@@ -0,0 +1,116 @@
+"""timeseries_store against a local zarr store in a temporary directory"""
+import pytest
+
+for module in ["numpy", "pandas", "dateutil", "zarr"]:
+    pytest.importorskip(module)
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import timeseries_store
+from timeseries_store import timeseries_store as store_class
+
+# not sorted, as lst_unique_grid may be
+grid = np.array([50, 3, 20, 7, 11], dtype=np.int32)
+start = datetime(2019, 1, 1)
+
+
+def make_grib2(hour, valid_hour=1, offset=0):
+    """grib2data of valid time start + hour with a = 10*hour + position of the grid point + offset, b = hour"""
+    df = pd.DataFrame({"timestamp_valid": "",
+                       "a": np.arange(len(grid), dtype=np.float32) + 10*hour + offset,
+                       "b": np.full(len(grid), hour, dtype=np.float32),
+                       "hrrr_id": grid})
+    return SimpleNamespace(url_grib2=f"f{hour}", lst_unique_grid=grid, valid_hour=valid_hour,
+                           valid_dttm=start + timedelta(hours=hour), df=df)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """store of time chunks of 4 hours and grid chunks of 2 points, flushed 2 grid chunks at a time"""
+    monkeypatch.setattr(timeseries_store, "n_chunks_block", 2)
+    return store_class(str(tmp_path/"timeseries.zarr"), start=start.strftime("%Y-%m-%d %H:%M:%S"), chunks=(4, 2))
+
+
+def get_staged_chunks(store, valid_hour=1):
+    if "staging" not in store.root or f"f{valid_hour:02}" not in store.root["staging"]:
+        return []
+    return sorted(store.root[f"staging/f{valid_hour:02}"].group_keys())
+
+
+def test_hours_are_staged_until_the_time_chunk_is_complete(store):
+    for hour in range(3):
+        store.write(make_grib2(hour))
+    assert get_staged_chunks(store) == ["c0"]
+    assert store.root["f01/values"].shape == (0, len(grid), 2)
+
+    store.write(make_grib2(3))
+    assert get_staged_chunks(store) == []
+    assert store.root["f01/values"].shape == (4, len(grid), 2)
+    assert list(store.root["f01/valid_time"][:]) == [0, 1, 2, 3]
+    np.testing.assert_array_equal(store.root["f01/values"][2, :, 0], np.arange(len(grid)) + 20)
+
+
+def test_flush_writes_a_partial_chunk(store):
+    store.write(make_grib2(5))
+    store.flush()
+
+    assert get_staged_chunks(store) == []
+    values = store.root["f01/values"]
+    assert values.shape == (8, len(grid), 2)
+    np.testing.assert_array_equal(values[5, :, 1], np.full(len(grid), 5))
+    # the hours not written are nan
+    assert np.isnan(values[4]).all() and np.isnan(values[:4]).all()
+
+
+def test_rewrite_replaces_its_hour_only(store):
+    for hour in range(4):
+        store.write(make_grib2(hour))
+    store.write(make_grib2(1, offset=100))
+    store.flush()
+
+    values = store.root["f01/values"]
+    np.testing.assert_array_equal(values[1, :, 0], np.arange(len(grid)) + 110)
+    for hour in [0, 2, 3]:
+        np.testing.assert_array_equal(values[hour, :, 0], np.arange(len(grid)) + 10*hour)
+
+
+def test_read_unsorted_grid_points(store):
+    for hour in range(4):
+        store.write(make_grib2(hour))
+    store.write(make_grib2(5))
+    store.flush()
+
+    df = store.read(1, [20, 50, 7], start, start + timedelta(hours=5))
+    assert list(df["hrrr_id"][:3]) == [20, 50, 7]
+    assert list(df["timestamp_valid"][::3]) == [(start + timedelta(hours=hour)).strftime("%Y-%m-%d %H:%M:%S")
+                                                for hour in range(6)]
+    # positions of 20, 50 and 7 in grid
+    np.testing.assert_array_equal(df["a"].values[:6], [2, 0, 3, 12, 10, 13])
+    assert np.isnan(df["a"].values[12:15]).all()
+    np.testing.assert_array_equal(df["b"].values[15:], [5, 5, 5])
+
+    with pytest.raises(KeyError):
+        store.read(1, [4], start, start)
+
+
+def test_other_grid_points_are_refused(store, tmp_path):
+    store.write(make_grib2(0))
+    # the group is checked once by every store object, i.e., by the next run
+    store_next = store_class(str(tmp_path/"timeseries.zarr"), start=start.strftime("%Y-%m-%d %H:%M:%S"), chunks=(4, 2))
+    grib2 = make_grib2(1)
+    grib2.lst_unique_grid = grid[::-1]
+
+    with pytest.raises(ValueError):
+        store_next.write(grib2)
+
+
+def test_empty_df_and_time_before_start(store):
+    grib2 = make_grib2(0)
+    grib2.df = pd.DataFrame()
+    store.write(grib2)
+    assert "f01" not in store.root
+
+    with pytest.raises(ValueError):
+        store.write(make_grib2(-1))
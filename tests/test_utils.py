@@ -0,0 +1,24 @@
+"""vectorized wind direction and its description against the scalar angle_desc"""
+import pytest
+
+for module in ["numpy", "dateutil"]:
+    pytest.importorskip(module)
+
+import numpy as np
+from utils import angle_desc, wind_direction, wind_direction_desc
+
+
+def test_wind_direction_desc_matches_angle_desc():
+    x = np.array([0, 22.4, 22.5, 67.5, 112.49, 157.5, 202.5, 247.5, 292.5, 337.49, 337.5, 359.99])
+    assert list(wind_direction_desc(x)) == [angle_desc(angle) for angle in x]
+
+
+def test_wind_direction_desc_of_nan_is_empty():
+    assert list(wind_direction_desc(np.array([np.nan, 90.0]))) == ["", "S"]
+
+
+def test_wind_direction():
+    u = np.array([1.0, 0.0, -1.0, 0.0])
+    v = np.array([0.0, 1.0, 0.0, -1.0])
+    np.testing.assert_allclose(wind_direction(u, v), [0, 90, 180, 270])
+    assert list(wind_direction_desc(wind_direction(u, v))) == ["W", "S", "E", "N"]
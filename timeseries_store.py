@@ -0,0 +1,168 @@
+"""zarr store of the outputs of grib2data ordered for time series reads of a few grid points.
+there is one group per forecast hour, f00, f01, ..., with the arrays
+values: float32 (valid_time, hrrr_id, variable), chunked by timeseries_chunks, all variables in one chunk
+valid_time: int64 hours since timeseries_start, hrrr_id: int32 grid points, in the order of lst_unique_grid
+a year of one grid point is 8760/timeseries_chunks[0] chunk reads.
+a grib2 file is first written to the staging group of its time chunk, staging/fNN/cK, whose chunks hold
+one hour of a block of grid points, so a file writes its own bytes only. when all hours of a time chunk are
+staged, or at flush, the time chunk is moved to values one block of grid points at a time, so a chunk of
+values is written once per timeseries_chunks[0] hours instead of once per file. writing a file again
+overwrites its hour only, and the time axis grows as later time chunks are flushed. values only has the
+flushed time chunks. writes are serialized in a process and only one process should write to a group at a time"""
+from utils import timeseries_path, timeseries_start, timeseries_chunks, dttm_format
+from numpy import arange, argsort, asarray, array_equal, float32, int32, int64, nan, searchsorted, stack, uint8
+from datetime import datetime, timedelta
+from threading import Lock
+import pandas as pd
+import zarr
+
+# chunks of grid points per block, a staged hour is written and a time chunk is flushed block by block
+n_chunks_block = 32
+
+
+def get_variables(df):
+    """numeric columns of the df of grib2data, i.e., the variables and the numeric derived columns"""
+    return [column for column in df.columns if column != "hrrr_id" and df[column].dtype.kind == "f"]
+
+
+class timeseries_store(object):
+    """time series of the outputs of grib2data in the zarr store at path"""
+    def __init__(self, path, start=timeseries_start, chunks=timeseries_chunks):
+        self.root = zarr.open_group(path, mode="a")
+        self.start = datetime.strptime(start, dttm_format)
+        self.chunks = chunks
+        self.n_points_block = chunks[1]*n_chunks_block
+        # groups already checked against the grid points and variables of the files, name -> group
+        self.dict_group = {}
+        self._lock = Lock()
+
+    def get_time_index(self, valid_dttm):
+        """position of valid_dttm on the time axis"""
+        return int((valid_dttm - self.start)/timedelta(hours=1))
+
+    def require_group(self, hour_forecast, lst_unique_grid, variables):
+        """group of hour_forecast, created with the grid points and variables of the first file written to it"""
+        name = f"f{hour_forecast:02}"
+        if name in self.dict_group:
+            group = self.dict_group[name]
+        elif name in self.root:
+            group = self.root[name]
+        else:
+            group = self.root.require_group(name)
+            group.attrs.update({"variables": variables, "start": self.start.strftime(dttm_format)})
+            hrrr_id = group.require_dataset("hrrr_id", shape=(len(lst_unique_grid),), chunks=(len(lst_unique_grid),),
+                                            dtype=int32)
+            hrrr_id[:] = lst_unique_grid
+            valid_time = group.require_dataset("valid_time", shape=(0,), chunks=(self.chunks[0],), dtype=int64)
+            values = group.require_dataset("values", shape=(0, len(lst_unique_grid), len(variables)),
+                                           chunks=(self.chunks[0], self.chunks[1], len(variables)),
+                                           dtype=float32, fill_value=nan)
+            # dimensions and time units read by xarray
+            hrrr_id.attrs["_ARRAY_DIMENSIONS"] = ["hrrr_id"]
+            valid_time.attrs.update({"_ARRAY_DIMENSIONS": ["valid_time"], "units": f"hours since {self.start}"})
+            values.attrs["_ARRAY_DIMENSIONS"] = ["valid_time", "hrrr_id", "variable"]
+
+        if name not in self.dict_group:
+            if group.attrs["variables"] != variables or not array_equal(group["hrrr_id"][:], lst_unique_grid):
+                raise ValueError(f"{name}: grid points or variables differ from those of the store")
+            self.dict_group[name] = group
+
+        return group
+
+    def require_staging(self, hour_forecast, i_chunk, n_points, n_variables):
+        """staging group of time chunk i_chunk of hour_forecast, with the hours staged so far"""
+        staging = self.root.require_group(f"staging/f{hour_forecast:02}/c{i_chunk}")
+        staging.require_dataset("values", shape=(self.chunks[0], n_points, n_variables),
+                                chunks=(1, self.n_points_block, n_variables), dtype=float32, fill_value=nan)
+        staging.require_dataset("staged", shape=(self.chunks[0],), chunks=(self.chunks[0],), dtype=uint8, fill_value=0)
+
+        return staging
+
+    def write(self, grib2):
+        """stage the df of grib2 at its valid time, the time chunk is flushed when all its hours are staged.
+        nothing is written for an empty df"""
+        if grib2.df.empty:
+            return
+        variables = get_variables(grib2.df)
+        lst_unique_grid = asarray(grib2.lst_unique_grid, dtype=int32)
+        i = self.get_time_index(grib2.valid_dttm)
+        if i < 0:
+            raise ValueError(f"{grib2.url_grib2}: valid time before the start of the store {self.start}")
+        slice_values = stack([grib2.df[column].values.astype(float32) for column in variables], axis=-1)
+        i_chunk, j = divmod(i, self.chunks[0])
+
+        with self._lock:
+            self.require_group(grib2.valid_hour, lst_unique_grid, variables)
+            staging = self.require_staging(grib2.valid_hour, i_chunk, len(lst_unique_grid), len(variables))
+            staging["values"][j] = slice_values
+            staging["staged"][j] = 1
+            if staging["staged"][:].all():
+                self.flush_chunk(grib2.valid_hour, i_chunk)
+
+    def flush_chunk(self, hour_forecast, i_chunk):
+        """move the staged hours of time chunk i_chunk of hour_forecast to values and remove its staging group.
+        the hours not staged keep the values they have"""
+        name = f"f{hour_forecast:02}"
+        group = self.root[name]
+        staging = self.root[f"staging/{name}/c{i_chunk}"]
+        staged = staging["staged"][:].astype(bool)
+        n_points, n_variables = staging["values"].shape[1:]
+        t_start, t_end = i_chunk*self.chunks[0], (i_chunk + 1)*self.chunks[0]
+
+        n_times = group["valid_time"].shape[0]
+        if t_end > n_times:
+            # grow the time axis by whole chunks
+            group["values"].resize((t_end, n_points, n_variables))
+            group["valid_time"].resize((t_end,))
+            group["valid_time"][n_times:] = arange(n_times, t_end, dtype=int64)
+
+        for p_start in range(0, n_points, self.n_points_block):
+            p_end = min(p_start + self.n_points_block, n_points)
+            if staged.all():
+                block = staging["values"][:, p_start:p_end]
+            else:
+                block = group["values"][t_start:t_end, p_start:p_end]
+                block[staged] = staging["values"].get_orthogonal_selection((staged.nonzero()[0], slice(p_start, p_end), slice(None)))
+            group["values"][t_start:t_end, p_start:p_end] = block
+
+        del self.root[f"staging/{name}"][f"c{i_chunk}"]
+
+    def flush(self):
+        """move all staged hours to values, i.e., at the end of a run"""
+        with self._lock:
+            if "staging" not in self.root:
+                return
+            for name in list(self.root["staging"].group_keys()):
+                for name_chunk in list(self.root[f"staging/{name}"].group_keys()):
+                    self.flush_chunk(int(name[1:]), int(name_chunk[1:]))
+
+    def read(self, hour_forecast, lst_hrrr_id, dttm_start, dttm_end):
+        """time series of some grid points between two valid times, both included, from the flushed values
+        input: lst_hrrr_id / grid points in the store, dttm_start, dttm_end / datetime
+        output: DataFrame with timestamp_valid, hrrr_id and the variables, nan for the times not written"""
+        group = self.root[f"f{hour_forecast:02}"]
+        hrrr_id = group["hrrr_id"][:]
+        lst_hrrr_id = asarray(lst_hrrr_id, dtype=int32)
+        # the grid points of the store are in the order of lst_unique_grid, which may not be sorted
+        order = argsort(hrrr_id)
+        positions_sorted = searchsorted(hrrr_id[order], lst_hrrr_id).clip(0, len(hrrr_id) - 1)
+        positions = order[positions_sorted]
+        if not array_equal(hrrr_id[positions], lst_hrrr_id):
+            raise KeyError(f"f{hour_forecast:02}: grid points not in the store")
+        i_start = max(0, self.get_time_index(dttm_start))
+        i_end = min(group["valid_time"].shape[0], self.get_time_index(dttm_end) + 1)
+
+        # the grid points are gathered from the chunks they are in
+        values = group["values"].get_orthogonal_selection((slice(i_start, i_end), positions, slice(None)))
+        n_times = values.shape[0]
+        timestamp_valid = [(self.start + timedelta(hours=i)).strftime(dttm_format) for i in range(i_start, i_start + n_times)]
+        df = pd.DataFrame({"timestamp_valid": [t for t in timestamp_valid for _ in lst_hrrr_id],
+                           "hrrr_id": list(lst_hrrr_id)*n_times})
+        for k, column in enumerate(group.attrs["variables"]):
+            df[column] = values[:, :, k].ravel()
+
+        return df
+
+
+# shared by all grib2data objects of this process, None if the store is not enabled
+store_timeseries = timeseries_store(timeseries_path) if timeseries_path else None
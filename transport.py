@@ -0,0 +1,103 @@
+"""shared HTTP session for all downloads: keep-alive connections, timeouts and
+retries with jittered exponential backoff on throttling, server errors,
+dropped connections and short reads of a byte range"""
+from utils import http_pool_size, http_timeout, http_retries, http_backoff, http_backoff_max
+from requests.adapters import HTTPAdapter
+from metrics import recorder
+import requests
+import random
+import time
+import re
+
+# status codes that are worth retrying
+status_retry = {429, 500, 502, 503, 504}
+# regex string to extract the total size from a Content-Range header, i.e., bytes 0-99/1000
+rs_content_range = r"bytes (\d+)-(\d+)/(\d+|\*)"
+
+session = None
+
+
+def configure(pool_size=http_pool_size):
+    """(re)create the shared session with pool_size keep-alive connections per host,
+    pool_size should be at least the number of concurrent downloads"""
+    global session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def backoff(attempt):
+    """seconds to wait before retry number attempt, full jitter"""
+    return random.uniform(0, min(http_backoff_max, http_backoff * 2**attempt))
+
+
+class ShortReadError(requests.exceptions.RequestException):
+    """fewer bytes than requested were received"""
+
+
+class range_response(object):
+    """the byte range of a response whose server ignored the Range header,
+    with the attributes of requests.Response used by the callers of get"""
+    def __init__(self, resp, content):
+        self.url = resp.url
+        self.headers = resp.headers
+        self.status_code = resp.status_code
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+def check_range(resp, range_start, range_end):
+    """raise ShortReadError if resp does not hold the whole byte range,
+    the size of the file is given by Content-Range of a 206 or by Content-Length of a 200"""
+    if range_end is not None:
+        n_expected = range_end - range_start + 1
+    else:
+        matched = re.findall(rs_content_range, resp.headers.get("Content-Range", ''))
+        if matched and matched[0][2] != '*':
+            n_expected = int(matched[0][2]) - range_start
+        elif resp.status_code == 200 and "Content-Length" in resp.headers:
+            n_expected = int(resp.headers["Content-Length"]) - range_start
+        else:
+            return
+    if len(resp.content) < n_expected:
+        raise ShortReadError(f"{resp.url}: {len(resp.content)} of {n_expected} bytes")
+
+
+def get(url, range_start=None, range_end=None):
+    """GET url, or its byte range range_start-range_end when range_start is given,
+    range_end None for the end of the file.
+    404 is returned to the caller, retryable failures are retried http_retries times
+    before the last exception is raised"""
+    if session is None:
+        configure()
+    headers = {}
+    if range_start is not None:
+        headers["Range"] = f"bytes={range_start}-{'' if range_end is None else range_end}"
+
+    with recorder.span("range_fetch" if range_start is not None else "http_get",
+                       url=url, range=headers.get("Range")) as attrs:
+        for attempt in range(http_retries + 1):
+            attrs["retries"] = attempt
+            try:
+                resp = session.get(url, headers=headers, timeout=http_timeout)
+                if resp.status_code in status_retry:
+                    resp.raise_for_status()
+                if resp.status_code == 200 and range_start is not None:
+                    # the server ignored the Range header, the range is cut from the whole file
+                    resp = range_response(resp, resp.content[range_start:None if range_end is None else range_end + 1])
+                    check_range(resp, range_start, range_end)
+                elif resp.status_code == 206:
+                    check_range(resp, range_start, range_end)
+                attrs["status"], attrs["bytes"] = resp.status_code, len(resp.content)
+                recorder.count("http_bytes", len(resp.content))
+                return resp
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError, ShortReadError) as e:
+                if attempt == http_retries:
+                    attrs["error"] = repr(e)
+                    raise
+                recorder.count("http_retries", url=url, error=repr(e))
+                time.sleep(backoff(attempt))
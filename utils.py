@@ -2,6 +2,7 @@ import os
 from dateutil import tz
 from datetime import datetime
 from pathlib import Path
+from numpy import arctan2, array, degrees, floor, isnan, mod, nan_to_num
 
 regex_local = r".*hrrr.(\d{8}).t(\d{2})z.wrfsfcf(\d{2}).grib2"
 regex_remote = r"gs:.*/hrrr.(\d{8})/conus/hrrr.t(\d{2})z.wrfsfcf(\d{2}).grib2"
@@ -9,6 +10,60 @@ regex_remote = r"gs:.*/hrrr.(\d{8})/conus/hrrr.t(\d{2})z.wrfsfcf(\d{2}).grib2"
 box = (33, 38, -100.5, -93)
 unit_mps_mph = 2.23694
 dttm_format = "%Y-%m-%d %H:%M:%S"
+# byte ranges of two messages closer than this are downloaded with one request
+range_gap_max = 1024*1024
+# memory cap of the decoded variables shared between grib2 files, see field_cache
+cache_fields_max_bytes = 512*1024*1024
+# directory of parsed idx files shared by runs, None to keep them in memory only,
+# and the number of parsed idx kept in memory, the least recently used are dropped
+cache_idx_dir = None
+cache_idx_max_entries = 2048
+# directory and disk budget of the downloaded messages, None to disable the cache, see byte_cache
+cache_bytes_dir = None
+cache_bytes_max_bytes = 50*1024**3
+# shared HTTP session, see transport: connections per host, (connect, read) timeouts in seconds,
+# number of retries and the base and cap of the exponential backoff in seconds
+http_pool_size = 32
+http_timeout = (10, 60)
+http_retries = 5
+http_backoff = 0.5
+http_backoff_max = 30
+# roots of the mirrors holding the same grib2 files, i.e., https://noaahrrr.blob.core.windows.net/hrrr,
+# https://<account>.blob.core.windows.net/hrrrdata/GRIB2 or https://storage.googleapis.com/high-resolution-rapid-refresh,
+# empty to download from the root of url_grib2 only, see mirrors. a range request is duplicated to the
+# next mirror when it takes longer than the hedge_percentile of the latencies of its mirror
+mirror_roots = []
+hedge_percentile = 90
+# seconds before hedging until a mirror has hedge_min_samples latencies, and the number of latencies kept per mirror
+hedge_delay_default = 1.0
+hedge_min_samples = 20
+hedge_latency_window = 500
+# output of grib2data: csv, parquet or arrow, and the compression of parquet and arrow
+output_format = "csv"
+output_compression = "zstd"
+# parallel block uploads of one output
+upload_max_concurrency = 4
+# SQLite manifest of the processed files, see manifest
+manifest_path = "manifest.sqlite"
+# grid index written by gen_grid_id.py, see grid_index, None to use the unique_grid_id dataset
+grid_index_path = None
+# output columns of grib2data, None for all of them, see grib2data.dict_column_var
+output_columns = None
+# append the derived columns to the output of grib2data, see grib2data.add_derived
+output_derived = False
+# JSON lines file of the timing spans and counters of grib2data, None to keep them in memory only, see metrics
+metrics_path = None
+# analysis hours of a day per batch claimed by a worker, and seconds of the lease on its lock blob, see lease.py
+lease_batch_hours = 6
+lease_duration = 60
+# zarr store of the time series of every grid point, a local directory or an fsspec url, None to write
+# the per-file outputs only, see timeseries_store. its valid times are hours since timeseries_start,
+# and a chunk holds timeseries_chunks = (hours, grid points) of all variables
+timeseries_path = None
+timeseries_start = "2019-01-01 00:00:00"
+timeseries_chunks = (24*30, 32)
+# analysis hours whose runs of forecast hours are processed at the same time by backfill_planner
+backfill_n_runs = 8
 
 storm_dir = Path("")
 
@@ -53,6 +108,28 @@ dict_var_index = {"temperature_2m": {"v2":54, "v3":66, "v4":71},
                   "lightning": {"v2":0, "v3": 0, "v4":57}
                  }
 
+"""
+HRRR variable name in the idx files: (shortName, level, time range)
+the time range is a regex, {h} and {h_prev} are replaced by the forecast hour and the previous forecast hour.
+a variable is looked up by name first and by its index in dict_var_index if the name is not found
+"""
+dict_var_name = {"temperature_2m": ("TMP", "2 m above ground", r"anl|{h} hour fcst"),
+                 "wind_10m": ("WIND", "10 m above ground", r".*"),
+                 "wind_10m_u": ("UGRD", "10 m above ground", r"anl|{h} hour fcst"),
+                 "wind_10m_v": ("VGRD", "10 m above ground", r"anl|{h} hour fcst"),
+                 "precipitation_tot": ("APCP", "surface", r"0-{h} hour acc fcst"),
+                 "precipitation_tot_past_h": ("APCP", "surface", r"{h_prev}-{h} hour acc fcst"),
+                 "snowfall_tot": ("ASNOW", "surface", r"0-{h} hour acc fcst"),
+                 "freezing_rain": ("FRZR", "surface", r"0-{h} hour acc fcst"),
+                 "wat_eq_accm_snow": ("WEASD", "surface", r"0-{h} hour acc fcst"),
+                 "composite_reflectivity": ("REFC", "entire atmosphere", r"anl|{h} hour fcst"),
+                 "wind_gust": ("GUST", "surface", r"anl|{h} hour fcst"),
+                 "CAPE255_h00_h01": ("CAPE", "255-0 mb above ground", r"anl|{h} hour fcst"),
+                 "CAPE255_h02plus": ("CAPE", "255-0 mb above ground", r"anl|{h} hour fcst"),
+                 "helicity": ("MXUPHL", "5000-2000 m above ground", r".*"),
+                 "lightning": ("LTPINX", "1 m above ground", r"anl|{h} hour fcst")
+                }
+
 def get_hrrr_ver(hour_forecast, n_messages):
     """get the version of HRRR GRIB2 file based on its forecast hour and number of variables"""
     v = "v0"
@@ -126,6 +203,21 @@ def str_local_timestamp(x):
     ret = datetime.strptime(x, "%Y-%m-%d %H:%M:%S").replace(tzinfo=from_zone).astimezone(to_zone).strftime(dttm_format)
     return ret
 
+# vectorized versions of the functions above, for arrays of a whole file
+
+# description of the 8 sectors of 45 degrees of angle_desc, starting at -22.5 degrees
+arr_angle_desc = array(["W", "SW", "S", "SE", "E", "NE", "N", "NW"])
+
+def wind_direction(u, v):
+    """angle360 of the direction of the wind vector (u, v) in degrees, for arrays"""
+    return mod(degrees(arctan2(v, u)), 360)
+
+def wind_direction_desc(x):
+    """angle_desc for arrays of angles in degrees, an empty string for nan"""
+    desc = arr_angle_desc[nan_to_num(floor((x + 22.5)/45) % 8).astype(int)]
+    desc[isnan(x)] = ''
+    return desc
+
 def filter_hours(x):
     """only return these hours"""
     if "t00z" in x or "t06z" in x or "t12z" in x or "t18z" in x: